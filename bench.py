@@ -0,0 +1,408 @@
+"""
+Benchmarks for loading and reporting at scale.
+
+Generates synthetic QFX statements and bank CSVs (one per format in parser.parsers), loads them into a throwaway
+sqlite database and times the load, list and bycat paths. Results are written as JSON so runs can be compared:
+
+    python bench.py --sizes 10000,100000 --output before.json
+
+--profiles runs everything once per sqlite profile (see db.SQLITE_PROFILES) to compare their import and query cost.
+--database-url runs it against a server database instead, e.g. a local PostgreSQL to exercise the COPY ingest path.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import sqlalchemy
+
+import columnar
+import db
+import loader
+import querycache
+from parser import parsers
+
+CITIES = ['SAN JOSE', 'PALO ALTO', 'MOUNTAIN VIEW', 'SUNNYVALE', 'SAN FRANCISCO', 'OAKLAND', 'BERKELEY',
+          'CUPERTINO', 'SANTA CLARA', 'REDWOOD CITY']
+NAMES = ['MARIOS', 'GOLDEN', 'LUCKY', 'SUNSET', 'BAYSIDE', 'MISSION', 'PACIFIC', 'OLD TOWN', 'CORNER', 'VILLAGE']
+
+# the schema the first thyme created (schema version 0), for timing and checking the upgrade of an old database.
+BASELINE_SCHEMA = """
+CREATE TABLE files (id INTEGER NOT NULL, name VARCHAR, mtime INTEGER, md5 VARCHAR, PRIMARY KEY (id));
+CREATE TABLE accounts (id INTEGER NOT NULL, nickname VARCHAR, fid INTEGER, name VARCHAR, type VARCHAR,
+    PRIMARY KEY (id), UNIQUE (nickname));
+CREATE TABLE categories (id INTEGER NOT NULL, parent_id INTEGER, name VARCHAR, budget INTEGER, PRIMARY KEY (id),
+    FOREIGN KEY(parent_id) REFERENCES categories (id));
+CREATE TABLE desc_category_mapping (id INTEGER NOT NULL, description VARCHAR, category_id INTEGER, PRIMARY KEY (id),
+    FOREIGN KEY(category_id) REFERENCES categories (id));
+CREATE TABLE transactions (id INTEGER NOT NULL, institution_id INTEGER, category_id INTEGER, date DATE,
+    fitid VARCHAR, description VARCHAR, amount FLOAT, new INTEGER, PRIMARY KEY (id),
+    FOREIGN KEY(institution_id) REFERENCES accounts (id), FOREIGN KEY(category_id) REFERENCES categories (id));
+"""
+
+# (description template, smallest amount, largest amount, relative frequency). Positive amounts are income.
+MERCHANTS = [
+    ("STARBUCKS STORE #{n} {city} CA", -9, -3, 30),
+    ("PEETS COFFEE & TEA #{n}", -9, -3, 20),
+    ("BLUE BOTTLE COFFEE {city}", -12, -4, 8),
+    ("SAFEWAY STORE #{n} {city} CA", -180, -15, 25),
+    ("WHOLEFDS {city} #{n}", -150, -10, 20),
+    ("TRADER JOE'S #{n} {city} CA", -120, -10, 20),
+    ("AMAZON.COM*{code} AMZN.COM/BILL WA", -250, -5, 30),
+    ("AMAZON MKTPLACE PMTS AMZN.COM/BILL WA", -90, -5, 15),
+    ("MACYS {city}", -300, -20, 4),
+    ("NORDSTROM #{n}", -400, -30, 3),
+    ("CHEVRON {n} {city} CA", -80, -25, 12),
+    ("SHELL OIL {n} {city} CA", -80, -25, 10),
+    ("VALERO {n}", -70, -20, 5),
+    ("CALTRAIN TVM {city}", -15, -3, 8),
+    ("BART-{city} CA", -12, -2, 6),
+    ("UBER TRIP {code} HELP.UBER.COM", -60, -7, 10),
+    ("PIZZERIA {name}", -45, -12, 8),
+    ("{name} KITCHEN {city}", -90, -15, 10),
+    ("{name} BISTRO", -120, -25, 5),
+    ("{name} DELI", -25, -7, 6),
+    ("CHIPOTLE {n}", -20, -8, 8),
+    ("UNITED AIRLINES {code}", -900, -150, 2),
+    ("ORBITZ*{code}", -600, -80, 1),
+    ("COMCAST CALIFORNIA", -150, -60, 1),
+    ("PACIFIC GAS AND ELECTRIC", -220, -40, 1),
+    ("AT&T*BILL PAYMENT", -120, -50, 1),
+    ("VONAGE *PRICING PLAN", -35, -25, 1),
+    ("NETFLIX.COM", -16, -9, 1),
+    ("AMC {city} 16", -40, -12, 2),
+    ("ATM WITHDRAWAL {n} {city}", -200, -20, 4),
+    ("CVS/PHARMACY #{n}", -60, -5, 6),
+    ("WALGREENS #{n}", -50, -5, 5),
+    ("SPA {name}", -150, -60, 1),
+    ("ONLINE PAYMENT THANK YOU", 200, 3000, 2),
+    ("PAYROLL DIRECT DEP {code}", 2500, 6000, 2),
+]
+
+
+def descriptions(rng):
+    weights = []
+    total = 0
+    for merchant in MERCHANTS:
+        total += merchant[3]
+        weights.append(total)
+
+    while True:
+        pick = rng.randint(1, total)
+        for merchant, weight in zip(MERCHANTS, weights):
+            if pick <= weight:
+                break
+        description = merchant[0].format(n=rng.randint(100, 9999), city=rng.choice(CITIES), name=rng.choice(NAMES),
+                                         code=''.join(rng.choice('ABCDEFGHJKLMNPQRSTUVWXYZ0123456789')
+                                                      for i in range(8)))
+        amount = rng.uniform(merchant[1], merchant[2])
+        yield description, round(amount, 2)
+
+
+def transactions(size, rng, years=5):
+    """size (date, description, amount, fitid) tuples spread evenly over the last few years, oldest first."""
+    end = date.today()
+    start = end - timedelta(days=365 * years)
+    days = (end - start).days
+    for i, (description, amount) in enumerate(descriptions(rng)):
+        if i == size:
+            return
+        yield start + timedelta(days=i * days // size), description, amount, "BENCH%09d" % i
+
+
+def write_qfx(path, txns, org="Bench Bank", fid=4242):
+    with open(path, 'w') as f:
+        f.write("OFXHEADER:100\nDATA:OFXSGML\nVERSION:102\n\n<OFX>\n<SIGNONMSGSRSV1><SONRS>"
+                "<STATUS><CODE>0<SEVERITY>INFO</STATUS><LANGUAGE>ENG\n"
+                "<FI><ORG>%s<FID>%d</FI></SONRS></SIGNONMSGSRSV1>\n"
+                "<CREDITCARDMSGSRSV1><CCSTMTTRNRS><CCSTMTRS><BANKTRANLIST>\n" % (org, fid))
+        for dt, description, amount, fitid in txns:
+            f.write("<STMTTRN><TRNTYPE>%s<DTPOSTED>%s120000.000[-8:PST]<TRNAMT>%.2f<FITID>%s<NAME>%s</STMTTRN>\n" % (
+                amount < 0 and "DEBIT" or "CREDIT", dt.strftime("%Y%m%d"), amount, fitid,
+                description.replace('&', '&amp;')))
+        f.write("</BANKTRANLIST></CCSTMTRS></CCSTMTTRNRS></CREDITCARDMSGSRSV1></OFX>\n")
+
+
+def csv_row(parser, dt, description, amount):
+    """A row the given parser.Parser reads back as (dt, description, amount)."""
+    width = max(parser.date_field, parser.description_field, parser.amount_field) + 1
+    row = [''] * width
+    row[parser.date_field] = dt.strftime(parser.date_format)
+    row[parser.description_field] = description
+    row[parser.amount_field] = '%.2f' % (parser.amount_negated and -amount or amount)
+    return row
+
+
+def write_csv(path, parser, txns):
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        for dt, description, amount, fitid in txns:
+            writer.writerow(csv_row(parser, dt, description, amount))
+
+
+class Quiet(object):
+    """Swallow what the loader prints while it is being timed."""
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+class Bench(object):
+    def __init__(self, workdir, repeat, url=None):
+        self.workdir = workdir
+        self.repeat = repeat
+        self.url = url
+        self.profile = None
+        self.results = []
+        self.databases = 0
+
+    def fresh_database(self):
+        self.databases += 1
+        if self.url:
+            # a server database: empty it out and let the next get_engine() create the schema again.
+            db.configure(self.url)
+            with db.get_engine().begin() as conn:
+                db.metadata.drop_all(conn)
+            db.configure(self.url)
+            db.get_engine()
+        else:
+            path = os.path.join(self.workdir, 'bench%d.db' % self.databases)
+            db.configure('sqlite:///' + path, self.profile)
+            db.get_engine()
+        # time the queries, not the query cache, which the query_cache_* benchmarks are for.
+        db.query_cache.size = 0
+        return self.url or path
+
+    def time(self, size, name, fn, repeat=1):
+        """Run fn repeat times and record the fastest run. fn returns the number of rows it handled."""
+        best = None
+        rows = 0
+        for i in range(repeat):
+            started = time.time()
+            with Quiet():
+                rows = fn()
+            seconds = time.time() - started
+            if best is None or seconds < best:
+                best = seconds
+        self.results.append({
+            'size': size,
+            'sqlite_profile': self.profile,
+            'benchmark': name,
+            'seconds': round(best, 6),
+            'rows': rows,
+            'rows_per_second': round(rows / best, 1) if best and rows else None})
+        sys.stderr.write("%-8s %-40s %9d rows %10.3f s\n" % (self.profile, name + " @" + str(size), rows or 0, best))
+
+    def run(self, profile, size, seed, files):
+        self.profile = profile
+        rng = random.Random(seed)
+        txns = list(transactions(size, rng))
+        size_dir = os.path.join(self.workdir, "%s-%d" % (profile, size))
+        os.mkdir(size_dir)
+
+        qfx_path = os.path.join(size_dir, 'statement.qfx')
+        write_qfx(qfx_path, txns)
+        for name, parser in sorted(parsers.items()):
+            csv_path = os.path.join(size_dir, name + '.csv')
+            write_csv(csv_path, parser, txns)
+            self.time(size, 'parse_csv_' + name, lambda: self.parse_csv(csv_path, parser))
+
+        self.fresh_database()
+        self.time(size, 'load_qfx', lambda: loader.load_qfx(file=qfx_path).inserted)
+
+        self.fresh_database()
+        for name in sorted(parsers):
+            self.time(size, 'load_xactions_' + name, lambda: self.load_csv(os.path.join(size_dir, name + '.csv'), name))
+
+        downloads = os.path.join(size_dir, 'downloads')
+        os.mkdir(downloads)
+        per_file = (size + files - 1) // files
+        for i in range(files):
+            write_qfx(os.path.join(downloads, 'statement%02d.qfx' % i), txns[i * per_file:(i + 1) * per_file],
+                      org="Bench Bank %d" % i, fid=5000 + i)
+        for jobs in sorted(set([1, files])):
+            self.fresh_database()
+            self.time(size, 'load_qfx_new_jobs%d' % jobs, lambda: self.load_new(downloads, jobs, size))
+
+        first, last = txns[0][0], txns[-1][0]
+        month = date(last.year, last.month, 1)
+        year = date(last.year, 1, 1)
+        everything = (date(first.year, first.month, 1), date(last.year + 1, 1, 1))
+
+        self.time(size, 'read_txn_for_time_month', lambda: self.count(db.read_txn_for_time(month, last)),
+                  self.repeat)
+        self.time(size, 'read_txn_for_time_all', lambda: self.count(db.read_txn_for_time(*everything)), self.repeat)
+        self.time(size, 'read_txn_for_time_filter', lambda: self.count(
+            db.read_txn_for_time(everything[0], everything[1], 'coffee')), self.repeat)
+        # the last page of list, by skipping everything before it and from the page before it.
+        offset = max(size - 50, 1)
+        before = list(db.read_txn_for_time(everything[0], everything[1], limit=1, offset=offset - 1))[0]
+        self.time(size, 'read_txn_for_time_page_offset', lambda: self.count(
+            db.read_txn_for_time(everything[0], everything[1], limit=50, offset=offset)), self.repeat)
+        self.time(size, 'read_txn_for_time_page_keyset', lambda: self.count(
+            db.read_txn_for_time(everything[0], everything[1], after=(before['date'], before['id']), limit=50)),
+            self.repeat)
+        self.time(size, 'read_txn_for_time_by_category_year', lambda: self.count(
+            db.read_txn_for_time_by_category(year, everything[1])), self.repeat)
+        self.time(size, 'read_txn_for_time_by_category_all', lambda: self.count(
+            db.read_txn_for_time_by_category(*everything)), self.repeat)
+        self.time(size, 'read_txn_for_time_by_category_days', lambda: self.count(
+            db.read_txn_for_time_by_category(everything[0] + timedelta(days=1), last)), self.repeat)
+
+        if columnar.available():
+            cache = columnar.TransactionCache()
+            self.time(size, 'cache_refresh', cache.refresh)
+            self.time(size, 'cache_transactions_all', lambda: len(cache.transactions(*everything)), self.repeat)
+            self.time(size, 'cache_by_category_all', lambda: len(cache.by_category(*everything)), self.repeat)
+            self.time(size, 'cache_by_category_days', lambda: len(
+                cache.by_category(everything[0] + timedelta(days=1), last)), self.repeat)
+            self.time(size, 'cache_top_descriptions_all', lambda: len(
+                cache.top_descriptions(everything[0], everything[1], 10)), self.repeat)
+        self.time(size, 'read_category_tree_all', lambda: self.count(db.read_category_tree(*everything)), self.repeat)
+        self.time(size, 'read_trend_months', lambda: len(db.read_trend(*everything)), self.repeat)
+        self.time(size, 'read_trend_weeks', lambda: len(db.read_trend(everything[0], everything[1], weekly=True)),
+                  self.repeat)
+        self.time(size, 'read_top_descriptions_all', lambda: self.count(
+            db.read_top_descriptions(everything[0], everything[1], 10)), self.repeat)
+
+        # bycat and list of a month, the second time round.
+        db.query_cache.size = querycache.SIZE
+        self.time(size, 'query_cache_miss_month', lambda: self.count(db.read_txn_for_time(month, last)) + self.count(
+            db.read_txn_for_time_by_category(month, everything[1])))
+        self.time(size, 'query_cache_hit_month', lambda: self.count(db.read_txn_for_time(month, last)) + self.count(
+            db.read_txn_for_time_by_category(month, everything[1])), self.repeat)
+        db.query_cache.size = 0
+
+        categories_map = db.load_categories()
+        desc_category_map = db.load_desc_category()
+        names = [tx[1] for tx in txns]
+        self.time(size, 'guess_category', lambda: len(
+            [db.guess_category(d, categories_map, desc_category_map) for d in names]))
+        self.time(size, 'categorize', lambda: len(db.categorize(names, categories_map, desc_category_map)))
+
+        # lots of small write transactions, where the journal mode and fsyncs show.
+        txids = [r['id'] for r in db.read_txn_for_time(*everything)][:200]
+        self.time(size, 'update_tx_category', lambda: len(
+            [db.update_tx_category(txid, categories_map[db.UNCATEGORIZED]) for txid in txids]))
+        self.time(size, 'update_tx_categories', lambda: db.update_tx_categories(txids, categories_map[db.COFFEE]))
+        self.time(size, 'recategorize', lambda: db.recategorize()[0])
+
+        if not self.url:
+            self.baseline_database(txns)
+            self.time(size, 'upgrade_schema_baseline', lambda: self.check_upgrade(txns))
+
+    def baseline_database(self, txns):
+        """A sqlite database as the first thyme would have left it after loading txns."""
+        self.databases += 1
+        path = os.path.join(self.workdir, 'bench%d.db' % self.databases)
+        conn = sqlite3.connect(path)
+        conn.executescript(BASELINE_SCHEMA)
+        conn.execute("INSERT INTO accounts (id, nickname, fid, name, type) VALUES (1, 'bench', 4242, 'Bench Bank', "
+                     "'CREDITCARD')")
+        conn.execute("INSERT INTO categories (id, name, budget) VALUES (1, 'uncategorized', 0)")
+        conn.executemany("INSERT INTO transactions (institution_id, category_id, date, fitid, description, amount, "
+                         "new) VALUES (1, 1, ?, ?, ?, ?, 1)",
+                         [(dt.isoformat(), fitid, description, amount) for dt, description, amount, fitid in txns])
+        conn.commit()
+        conn.close()
+        db.configure('sqlite:///' + path, self.profile)
+
+    @staticmethod
+    def check_upgrade(txns):
+        """Upgrade the configured database and check that every transaction, and its amount, made it through."""
+        engine = db.get_engine()
+        db.query_cache.size = 0
+        if db.schema_version(engine) != db.SCHEMA_VERSION:
+            raise RuntimeError("upgraded to schema version %s instead of %d" % (
+                db.schema_version(engine), db.SCHEMA_VERSION))
+
+        cents = sum(int(round(amount * 100)) for dt, description, amount, fitid in txns)
+        everything = (date(txns[0][0].year, 1, 1), date(txns[-1][0].year + 1, 1, 1))
+        totals = [row[1] for row in db.read_txn_for_time_by_category(*everything)]
+        if sum(totals) != cents:
+            raise RuntimeError("monthly totals add up to %d cents instead of %d" % (sum(totals), cents))
+        rows = sum(1 for tx in db.read_txn_for_time(*everything, load_id=db.latest_load_id()))
+        if rows != len(txns):
+            raise RuntimeError("%d of %d transactions were in the last load after upgrading" % (rows, len(txns)))
+        return rows
+
+    @staticmethod
+    def parse_csv(path, parser):
+        with open(path) as f:
+            return len([parser.parse(row) for row in csv.reader(f)])
+
+    @staticmethod
+    def load_csv(path, name):
+        with open(path) as f:
+            return loader.load_xactions(file=f, parser=name, institution=name).inserted
+
+    @staticmethod
+    def load_new(downloads, jobs, size):
+        loader.load_qfx_new(downloads, jobs=jobs)
+        return size
+
+    @staticmethod
+    def count(rows):
+        return len(list(rows))
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'sqlite': sqlite3.sqlite_version,
+        'numpy': columnar.available() and columnar.numpy.__version__ or None,
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='benchmark loading and reporting on synthetic statements')
+    arg_parser.add_argument('--sizes', default='10000',
+                            help='comma separated transaction counts, e.g. 10000,100000,1000000')
+    arg_parser.add_argument('--profiles', default=db.DEFAULT_SQLITE_PROFILE,
+                            help='comma separated sqlite profiles to compare (%s)' %
+                                 ', '.join(sorted(db.SQLITE_PROFILES)))
+    arg_parser.add_argument('--database-url',
+                            help='benchmark this (throwaway!) database, e.g. postgresql://localhost/thyme_bench, '
+                                 'instead of sqlite files. All thyme tables in it are dropped.')
+    arg_parser.add_argument('--files', type=int, default=4, help='statements load_qfx_new gets to load')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='runs per query benchmark, the fastest is kept')
+    arg_parser.add_argument('--seed', type=int, default=1, help='seed for the synthetic data')
+    arg_parser.add_argument('--keep', action='store_true', help="don't delete the generated files and databases")
+    arg_parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = arg_parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='thyme-bench-')
+    bench = Bench(workdir, args.repeat, args.database_url)
+    try:
+        for profile in args.profiles.split(','):
+            for size in [int(s) for s in args.sizes.split(',')]:
+                bench.run(profile, size, args.seed, args.files)
+    finally:
+        if args.keep:
+            sys.stderr.write("generated files are in %s\n" % workdir)
+        else:
+            shutil.rmtree(workdir)
+
+    report = json.dumps({'environment': environment(), 'sizes': args.sizes, 'profiles': args.profiles,
+                         'seed': args.seed, 'results': bench.results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + "\n")
+    else:
+        print(report)
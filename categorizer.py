@@ -0,0 +1,43 @@
+"""
+Matches transaction descriptions against category patterns.
+
+Patterns of the same priority are compiled into one regular expression, so categorizing a description is a scan per
+priority level (usually two: the user's patterns and the built in ones) no matter how many patterns there are.
+"""
+import re
+
+
+class CategoryMatcher(object):
+    """
+    Built from (pattern, category_id, priority) rules, highest priority first. A pattern only matches whole words, so
+    'tea' matches 'peets coffee & tea' but not 'steakhouse'. A matching pattern of a higher priority always wins. Of
+    the patterns with the same priority, the one that starts earliest in the description wins, and patterns starting
+    at the same place are resolved by rule order.
+    """
+
+    def __init__(self, rules):
+        self.categories = {}
+        self.regexes = []
+        tier, patterns = None, []
+        for pattern, category_id, priority in rules:
+            if priority != tier:
+                self.add_tier(patterns)
+                tier, patterns = priority, []
+            pattern = pattern.strip().lower()
+            if pattern and pattern not in self.categories:
+                self.categories[pattern] = category_id
+                patterns.append(re.escape(pattern))
+        self.add_tier(patterns)
+
+    def add_tier(self, patterns):
+        if patterns:
+            # \b does not work for patterns that start or end with punctuation (at&t, peet's), look arounds do.
+            self.regexes.append(re.compile(r'(?<!\w)(?:' + '|'.join(patterns) + r')(?!\w)', re.UNICODE))
+
+    def match(self, cleaned_description):
+        """Return the category id for an already cleaned (stripped, lower cased) description, or None."""
+        for regex in self.regexes:
+            m = regex.search(cleaned_description)
+            if m:
+                return self.categories[m.group(0)]
+        return None
@@ -0,0 +1,179 @@
+"""
+An in-memory, column per field copy of the transactions table for the analytical commands.
+
+Dates are kept as day numbers (date.toordinal()), amounts as cents, categories and accounts as ids and descriptions
+as codes into a dictionary of the distinct descriptions. Date ranges, sums by category and top N questions are then
+answered with numpy operations over whole columns instead of a query and a RowProxy per row.
+
+numpy is optional, thyme works the same without it, only without the cache.
+"""
+from datetime import date
+
+from sqlalchemy import select
+
+import db
+
+# numpy is a good part of thyme's start up time, so it is only imported once something asks for the cache. False
+# once the import has failed.
+numpy = None
+
+FETCH_SIZE = 10000
+
+
+def available():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy is not False
+
+
+def day(value):
+    if value is None:
+        return 0
+    return value.toordinal()
+
+
+class TransactionCache(object):
+    """
+    The transactions, in id order. refresh() appends whatever was inserted since the last call, which every query
+    does first, so loads show up without reloading everything. Category changes to rows already in the cache have to
+    be told with set_category.
+    """
+
+    def __init__(self):
+        if not available():
+            raise RuntimeError("the transaction cache needs numpy")
+        self.ids = numpy.zeros(0, dtype=numpy.int64)
+        self.days = numpy.zeros(0, dtype=numpy.int32)
+        self.cents = numpy.zeros(0, dtype=numpy.int64)
+        self.categories = numpy.zeros(0, dtype=numpy.int32)
+        self.accounts = numpy.zeros(0, dtype=numpy.int32)
+        self.descriptions = numpy.zeros(0, dtype=numpy.int32)
+        self.description_values = []
+        self.description_codes = {}
+        self.category_names = {}
+        self.account_names = {}
+        self.max_id = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def refresh(self):
+        """Append the transactions inserted since the last refresh. Returns how many there were."""
+        xactions = db.xactions
+        stmt = select([xactions.c.id, xactions.c.date, xactions.c.amount_cents, xactions.c.category_id,
+                       xactions.c.institution_id, xactions.c.description]). \
+            where(xactions.c.id > self.max_id). \
+            order_by(xactions.c.id)
+
+        ids, days, cents, categories, accounts, descriptions = [], [], [], [], [], []
+        codes = self.description_codes
+        result = db.get_engine().execute(stmt)
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                ids.append(row[0])
+                days.append(day(row[1]))
+                cents.append(row[2] or 0)
+                categories.append(row[3] or 0)
+                accounts.append(row[4] or 0)
+                code = codes.get(row[5])
+                if code is None:
+                    code = codes[row[5]] = len(self.description_values)
+                    self.description_values.append(row[5])
+                descriptions.append(code)
+
+        if ids:
+            self.ids = numpy.concatenate((self.ids, numpy.array(ids, dtype=numpy.int64)))
+            self.days = numpy.concatenate((self.days, numpy.array(days, dtype=numpy.int32)))
+            self.cents = numpy.concatenate((self.cents, numpy.array(cents, dtype=numpy.int64)))
+            self.categories = numpy.concatenate((self.categories, numpy.array(categories, dtype=numpy.int32)))
+            self.accounts = numpy.concatenate((self.accounts, numpy.array(accounts, dtype=numpy.int32)))
+            self.descriptions = numpy.concatenate((self.descriptions, numpy.array(descriptions, dtype=numpy.int32)))
+            self.max_id = ids[-1]
+
+        # both are tiny, reading them again is cheaper than keeping track of renames.
+        self.category_names = dict((r['id'], r['name']) for r in db.list_categories())
+        self.account_names = dict((r['id'], r['nickname']) for r in db.list_institutions())
+        return len(ids)
+
+    def set_category(self, txids, category_id):
+        """Move the given transactions, which have already been updated in the database, to category_id."""
+        txids = numpy.asarray(txids, dtype=numpy.int64)
+        positions = numpy.searchsorted(self.ids, txids)
+        inside = positions < len(self.ids)
+        positions = positions[inside]
+        positions = positions[self.ids[positions] == txids[inside]]
+        self.categories[positions] = category_id
+        return len(positions)
+
+    def in_range(self, start, end):
+        """Positions of the transactions dated start (inclusive) to end (exclusive)."""
+        self.refresh()
+        return numpy.flatnonzero((self.days >= day(start)) & (self.days < day(end)))
+
+    def transactions(self, start, end, after=None, limit=None, offset=None):
+        """The same rows as db.read_txn_for_time without a filter, in (date, id) order and paged the same way."""
+        positions = self.in_range(start, end)
+        if after is not None:
+            after_day, after_id = day(after[0]), after[1]
+            days, ids = self.days[positions], self.ids[positions]
+            positions = positions[(days > after_day) | ((days == after_day) & (ids > after_id))]
+        # ids are ascending, a stable sort on the day keeps them in id order within a day.
+        positions = positions[numpy.argsort(self.days[positions], kind='mergesort')]
+        positions = positions[offset or 0:(offset or 0) + limit if limit else None]
+        return self.rows(positions)
+
+    def by_category(self, start, end):
+        """(category name, total cents) for each category with transactions between start and end."""
+        positions = self.in_range(start, end)
+        categories = self.categories[positions]
+        if not len(categories):
+            return []
+        size = max(self.category_names.keys() + [int(categories.max())]) + 1
+        counts = numpy.bincount(categories, minlength=size)
+        totals = numpy.zeros(size, dtype=numpy.int64)
+        numpy.add.at(totals, categories, self.cents[positions])
+        # like the join in db.read_txn_for_time_by_category, transactions without a category (0) are left out.
+        rows = [(self.category_names[c], int(totals[c])) for c in numpy.flatnonzero(counts)
+                if c in self.category_names]
+        return sorted(rows)
+
+    def top_transactions(self, start, end, n):
+        """The n biggest expenses between start and end, biggest first."""
+        positions = self.in_range(start, end)
+        positions = positions[self.cents[positions] < 0]
+        positions = positions[numpy.argsort(self.cents[positions], kind='mergesort')[:n]]
+        return self.rows(positions)
+
+    def top_descriptions(self, start, end, n):
+        """(description, number of transactions, total cents) of the n descriptions where most money went."""
+        positions = self.in_range(start, end)
+        codes = self.descriptions[positions]
+        if not len(codes):
+            return []
+        totals = numpy.zeros(len(self.description_values), dtype=numpy.int64)
+        numpy.add.at(totals, codes, self.cents[positions])
+        counts = numpy.bincount(codes, minlength=len(self.description_values))
+        top = numpy.argsort(totals, kind='mergesort')[:n]
+        return [(self.description_values[c], int(counts[c]), int(totals[c])) for c in top if totals[c] < 0]
+
+    def rows(self, positions):
+        """Dicts with the keys of db.read_txn_for_time rows, a column at a time rather than a row at a time."""
+        dates = {}
+        for d in numpy.unique(self.days[positions]).tolist():
+            dates[d] = date.fromordinal(d)
+        values = self.description_values
+        category_names = self.category_names
+        account_names = self.account_names
+        return [{'id': i, 'description': values[code], 'date': dates[d], 'amount_cents': cents,
+                 'name': category_names.get(category, 'uncategorized'), 'nickname': account_names.get(account)}
+                for i, d, cents, category, account, code in zip(
+                    self.ids[positions].tolist(), self.days[positions].tolist(), self.cents[positions].tolist(),
+                    self.categories[positions].tolist(), self.accounts[positions].tolist(),
+                    self.descriptions[positions].tolist())]
@@ -0,0 +1,28 @@
+"""
+User configuration, read once from ~/.thyme/config.json (or the file named by THYME_CONFIG). A missing file is the
+same as an empty one.
+"""
+import json
+import os
+from os.path import expanduser
+
+_config = None
+
+
+def path():
+    return os.environ.get('THYME_CONFIG') or os.path.join(expanduser("~"), ".thyme", "config.json")
+
+
+def load():
+    global _config
+    if _config is None:
+        if os.path.exists(path()):
+            with open(path()) as f:
+                _config = json.load(f)
+        else:
+            _config = {}
+    return _config
+
+
+def get(key, default=None):
+    return load().get(key, default)
@@ -1,24 +1,49 @@
 import os
-
-from sqlalchemy import create_engine, MetaData
-from sqlalchemy import Table, Column, Integer, String, Text, ForeignKey, Date, Float, or_
-from sqlalchemy.sql import select, func, update
-from datetime import date
+import re
+import time
+import hashlib
+import threading
+from functools import wraps
+from itertools import islice
+
+from sqlalchemy import create_engine, MetaData, event, inspect
+from sqlalchemy import Table, Column, Integer, String, Text, ForeignKey, Date, DateTime, Index, or_, and_
+from sqlalchemy.sql import select, func, update, text, extract, bindparam, cast
+from sqlalchemy.exc import OperationalError, DBAPIError
+from sqlalchemy.pool import QueuePool
+from datetime import date, datetime
 from sqlite3 import dbapi2 as sqlite
+from categorizer import CategoryMatcher
+from querycache import QueryCache
+import querycache
+import config
 
 import logging
 
 logging.basicConfig(filename='thyme.log', level=logging.INFO)
-logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
-if os.environ.get('HEROKU') is None:
-#    engine = create_engine('postgres://@localhost/thyme')
-    engine = create_engine('sqlite+pysqlite:///thyme.db', module=sqlite)
-else:
-    print("database URL is: " + os.environ['DATABASE_URL'])
-    engine = create_engine(os.environ['DATABASE_URL'])
 
-metadata = MetaData(bind=engine)
+def log_sql(on):
+    """Echo every SQL statement to thyme.log. Off unless THYME_SQL_LOG is set or turned on with 'sqllog on'."""
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO if on else logging.WARN)
+
+
+log_sql(bool(os.environ.get('THYME_SQL_LOG')))
+
+# The engine is created, and the schema checked, the first time something needs the database. Importing db (and
+# loader) is cheap and the thyme> prompt doesn't wait on sqlite.
+engine = None
+database_url = None
+
+# (step, seconds) for everything done to get the database ready, see startup_report().
+startup_timings = []
+
+# results of the cached_read queries, for as long as nothing has been written since they were read.
+query_cache = QueryCache()
+# the sqlite file the engine is on, writes to it by other processes show in its (and its wal's) size and mtime.
+database_file = None
+
+metadata = MetaData()
 
 finins = Table('accounts', metadata,
                Column('id', Integer, primary_key=True),
@@ -33,6 +58,12 @@ categories = Table('categories', metadata,
                    Column('name', String),
                    Column('budget', Integer, default=0))
 
+# one row per import, so the transactions and files it brought in can be told apart from the rest.
+loads = Table('loads', metadata,
+              Column('id', Integer, primary_key=True),
+              Column('started', DateTime),
+              Column('source', String))
+
 xactions = Table('transactions', metadata,
                  Column('id', Integer, primary_key=True),
                  Column('institution_id', Integer, ForeignKey('accounts.id')),
@@ -40,8 +71,12 @@ xactions = Table('transactions', metadata,
                  Column('date', Date),
                  Column('fitid', String),
                  Column('description', String),
-                 Column('amount', Float),
-                 Column('new', Integer, default=1))
+                 # whole cents, so sums are exact. Databases from before cents still have the old float amount
+                 # column, it is no longer read or written.
+                 Column('amount_cents', Integer),
+                 Column('load_id', Integer, ForeignKey('loads.id')),
+                 # set on the rows of the last load before loads were tracked, see migrate_load_batches.
+                 Column('new', Integer))
 
 description_category_mapping = Table('desc_category_mapping', metadata,
                                      Column('id', Integer, primary_key=True),
@@ -50,11 +85,335 @@ description_category_mapping = Table('desc_category_mapping', metadata,
 
 files_loaded = Table('files', metadata,
                      Column('id', Integer, primary_key=True),
-                     Column('name', String),
+                     Column('name', String, index=True),
                      Column('mtime', Integer),
-                     Column('md5', String))
+                     Column('md5', String, index=True),
+                     Column('size', Integer),
+                     Column('load_id', Integer, ForeignKey('loads.id')))
+
+category_patterns = Table('category_patterns', metadata,
+                          Column('id', Integer, primary_key=True),
+                          Column('category_id', Integer, ForeignKey('categories.id')),
+                          Column('pattern', String),
+                          Column('priority', Integer, default=0))
+
+# per month, category and account totals of transactions.amount_cents, kept in step with the transactions table by every
+# write so bycat doesn't have to aggregate over all of history.
+monthly_totals = Table('monthly_totals', metadata,
+                       Column('year', Integer, primary_key=True),
+                       Column('month', Integer, primary_key=True),
+                       Column('category_id', Integer, ForeignKey('categories.id'), primary_key=True),
+                       Column('institution_id', Integer, ForeignKey('accounts.id'), primary_key=True),
+                       Column('total', Integer, default=0),
+                       Column('count', Integer, default=0))
+
+schema_info = Table('schema_info', metadata,
+                    Column('version', Integer))
+
+# fitids are only unique within an institution. The unique index doubles as the lookup index for de-duplication.
+Index('ix_transactions_institution_fitid', xactions.c.institution_id, xactions.c.fitid, unique=True)
+# covering indexes for the date range scans done by list and the per category aggregation done by bycat.
+Index('ix_transactions_date', xactions.c.date, xactions.c.category_id, xactions.c.amount_cents)
+Index('ix_transactions_category_date', xactions.c.category_id, xactions.c.date, xactions.c.amount_cents)
+Index('ix_transactions_load_id', xactions.c.load_id)
+
+
+def create_description_index(conn):
+    """
+    Full text index over transactions.description, kept current by triggers. Only sqlite builds with fts5 get one,
+    everything else falls back to LIKE.
+    """
+    if conn.dialect.name != 'sqlite':
+        return
+    # sqlite commits before DDL, so after an upgrade that died half way any of this may exist already.
+    try:
+        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING "
+                          "fts5(description, content='transactions', content_rowid='id')"))
+    except OperationalError as e:
+        if 'no such module' not in str(e):
+            raise
+        logging.info("sqlite has no fts5, searching descriptions with LIKE")
+        return
+
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS transactions_fts_insert AFTER INSERT ON transactions BEGIN "
+                      "INSERT INTO transactions_fts(rowid, description) VALUES (new.id, new.description); END"))
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS transactions_fts_delete AFTER DELETE ON transactions BEGIN "
+                      "INSERT INTO transactions_fts(transactions_fts, rowid, description) "
+                      "VALUES ('delete', old.id, old.description); END"))
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS transactions_fts_update AFTER UPDATE OF description ON transactions "
+                      "BEGIN "
+                      "INSERT INTO transactions_fts(transactions_fts, rowid, description) "
+                      "VALUES ('delete', old.id, old.description); "
+                      "INSERT INTO transactions_fts(rowid, description) VALUES (new.id, new.description); END"))
+    conn.execute(text("INSERT INTO transactions_fts(transactions_fts) VALUES ('rebuild')"))
+
+
+event.listen(xactions, 'after_create', lambda target, conn, **kw: create_description_index(conn))
+
+
+# Migrations spell out their DDL rather than taking it from the tables above, which describe the latest schema: an
+# index on a column added by a later migration can't be created yet. sqlite commits before DDL, so an upgrade that
+# died half way may have done some of it already, hence the IF NOT EXISTS and add_missing_column.
+
+
+def add_missing_column(conn, table, column, type):
+    if column not in set(c['name'] for c in inspect(conn).get_columns(table)):
+        conn.execute(text("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, type)))
+
+
+def migrate_transaction_indexes(conn):
+    # older databases de-duplicated on fitid with a SELECT per row, get rid of anything that slipped through before
+    # adding the unique index.
+    conn.execute(text("DELETE FROM transactions WHERE fitid IS NOT NULL AND id NOT IN "
+                      "(SELECT MIN(id) FROM transactions WHERE fitid IS NOT NULL GROUP BY institution_id, fitid)"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_transactions_institution_fitid "
+                      "ON transactions (institution_id, fitid)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_date ON transactions (date, category_id, amount)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_category_date "
+                      "ON transactions (category_id, date, amount)"))
+
+
+def migrate_category_patterns(conn):
+    category_patterns.create(conn, checkfirst=True)
+
+
+def migrate_file_digests(conn):
+    add_missing_column(conn, 'files', 'size', 'INTEGER')
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_files_name ON files (name)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_files_md5 ON files (md5)"))
+
+
+def migrate_monthly_totals(conn):
+    # filled in by migrate_amount_cents, which every database upgraded past this point goes through.
+    monthly_totals.create(conn, checkfirst=True)
+
+
+def migrate_description_index(conn):
+    create_description_index(conn)
+
+
+def migrate_amount_cents(conn):
+    add_missing_column(conn, 'transactions', 'amount_cents', 'INTEGER')
+    conn.execute(text("UPDATE transactions SET amount_cents = CAST(ROUND(amount * 100) AS INTEGER)"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_transactions_date"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_transactions_category_date"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_date "
+                      "ON transactions (date, category_id, amount_cents)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_category_date "
+                      "ON transactions (category_id, date, amount_cents)"))
+
+    # the totals are derived data, recreate them with an integer total.
+    monthly_totals.drop(conn, checkfirst=True)
+    monthly_totals.create(conn)
+    rebuild_monthly_totals(conn)
+
+
+def migrate_load_batches(conn):
+    loads.create(conn, checkfirst=True)
+    add_missing_column(conn, 'transactions', 'load_id', 'INTEGER')
+    add_missing_column(conn, 'files', 'load_id', 'INTEGER')
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_load_id ON transactions (load_id)"))
+
+    # whatever the last load command marked as new becomes the first load we know about.
+    if conn.execute(text("SELECT 1 FROM transactions WHERE new > 0 LIMIT 1")).fetchone():
+        load_id = conn.execute(loads.insert(), source='before load tracking').inserted_primary_key[0]
+        conn.execute(text("UPDATE transactions SET load_id = :load_id WHERE new > 0"), load_id=load_id)
+
+
+# Each migration upgrades the schema by one version. New databases are created at the latest version by
+# create_all, so migrations only ever run against databases created by an older thyme.
+MIGRATIONS = [migrate_transaction_indexes, migrate_category_patterns, migrate_file_digests,
+              migrate_monthly_totals, migrate_description_index, migrate_amount_cents, migrate_load_batches]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def upgrade_schema(conn):
+    fresh = not conn.dialect.has_table(conn, xactions.name)
+    metadata.create_all(conn)
+
+    row = conn.execute(select([schema_info.c.version])).fetchone()
+    if row is None:
+        version = SCHEMA_VERSION if fresh else 0
+        conn.execute(schema_info.insert(), version=version)
+    else:
+        version = row[0]
+
+    for migration in MIGRATIONS[version:]:
+        logging.info("Upgrading schema from version %d: %s" % (version, migration.__name__))
+        migration(conn)
+        version += 1
+        conn.execute(schema_info.update().values(version=version))
+
+    seed_categories(conn)
+
+
+def schema_version(conn):
+    try:
+        return conn.execute(select([schema_info.c.version])).scalar()
+    except DBAPIError:
+        return None
+
+
+# pragmas run on every new sqlite connection, picked with THYME_SQLITE_PROFILE or "sqlite_profile" in the config file.
+# Individual pragmas can be overridden with "sqlite_pragmas" in the config file.
+SQLITE_PROFILES = {
+    # whatever sqlite defaults to: rollback journal, synchronous=FULL, no mmap.
+    'default': [],
+    # WAL lets list and bycat read while a load is writing, and with synchronous=NORMAL a commit doesn't wait for
+    # an fsync. A crash can lose the last transactions, but never corrupts the database.
+    'fast': [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('mmap_size', 256 * 1024 * 1024),
+             ('cache_size', -64 * 1024), ('temp_store', 'MEMORY'), ('busy_timeout', 5000)],
+    'safe': [('journal_mode', 'WAL'), ('synchronous', 'FULL'), ('busy_timeout', 5000)],
+}
+DEFAULT_SQLITE_PROFILE = 'fast'
+
+sqlite_profile = None
+
+
+def configure(url, profile=None):
+    """
+    Use the database at url instead of the default one, with the named sqlite profile if it is a sqlite database.
+    Has to be called before the database is first used.
+    """
+    global database_url, sqlite_profile, engine, _description_index
+    database_url = url
+    sqlite_profile = profile
+    engine = None
+    _description_index = None
+    reset_matcher()
+    query_cache.clear()
+
+
+def sqlite_pragmas():
+    profile = sqlite_profile or os.environ.get('THYME_SQLITE_PROFILE') or \
+        config.get('sqlite_profile', DEFAULT_SQLITE_PROFILE)
+    if profile not in SQLITE_PROFILES:
+        raise ValueError("no sqlite profile called '%s', pick one of %s" % (profile, ', '.join(sorted(SQLITE_PROFILES))))
+    pragmas = list(SQLITE_PROFILES[profile])
+    for name, value in sorted(config.get('sqlite_pragmas', {}).items()):
+        pragmas = [p for p in pragmas if p[0] != name] + [(name, value)]
+    return pragmas
+
+
+def create_sqlite_engine(url):
+    # sqlalchemy opens a new connection per statement for sqlite files by default. Pool them instead, so the
+    # pragmas, page cache and mmap outlive a statement. Connections may be handed to another thread, but only
+    # ever to one at a time.
+    engine = create_engine(url, module=sqlite, poolclass=QueuePool, pool_size=5,
+                           connect_args={'check_same_thread': False})
+    pragmas = sqlite_pragmas()
+
+    def apply_pragmas(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        for name, value in pragmas:
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+
+    if pragmas:
+        event.listen(engine, 'connect', apply_pragmas)
+    return engine
+
+
+WRITE_STATEMENT = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b', re.IGNORECASE)
+
+
+def note_write(conn, cursor, statement, parameters, context, executemany):
+    if WRITE_STATEMENT.match(statement):
+        # once now, and again when the connection goes back to the pool, which is after the commit: a query that
+        # ran in between may have read the data from before the write.
+        conn.info['wrote'] = True
+        query_cache.changed()
+
+
+def note_checkin(dbapi_conn, connection_record):
+    if connection_record.info.pop('wrote', False):
+        query_cache.changed()
+
+
+def watch_writes(engine):
+    """Bump the query cache generation whenever something is written through engine."""
+    global database_file
+    event.listen(engine, 'after_cursor_execute', note_write)
+    event.listen(engine.pool, 'checkin', note_checkin)
+    database_file = None
+    if engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:'):
+        database_file = engine.url.database
+    query_cache.size = config.get('query_cache_size', querycache.SIZE)
+
+
+def data_version():
+    """Size and mtime of the sqlite file and its wal, None for other databases."""
+    if database_file is None:
+        return None
+    version = []
+    for path in (database_file, database_file + '-wal'):
+        try:
+            stat = os.stat(path)
+            version.append((stat.st_size, stat.st_mtime))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+def cached_read(read):
+    """
+    Answer read from the query cache while nothing has been written to the database. The rows come back as a list
+    (unless there are too many to keep), see querycache.
+    """
+    @wraps(read)
+    def cached(*args, **kwargs):
+        get_engine()
+        key = (read.__name__, data_version(), args, tuple(sorted(kwargs.items())))
+        return query_cache.get(key, lambda: read(*args, **kwargs))
+    return cached
+
+
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    global engine
+    if engine is not None:
+        return engine
+
+    # background loads and the watcher can get here at the same time as the prompt, only one of them sets it up.
+    with _engine_lock:
+        if engine is not None:
+            return engine
+
+        started = time.time()
+        if database_url:
+            url = database_url
+        elif os.environ.get('HEROKU') is None:
+            url = 'sqlite+pysqlite:///thyme.db'
+        else:
+            print("database URL is: " + os.environ['DATABASE_URL'])
+            url = os.environ['DATABASE_URL']
+
+        if url.startswith('sqlite'):
+            new_engine = create_sqlite_engine(url)
+        else:
+            new_engine = create_engine(url)
+        watch_writes(new_engine)
+        startup_timings.append(('create engine', time.time() - started))
+
+        # once a database is at the current version, getting it ready is this one query.
+        started = time.time()
+        current = schema_version(new_engine) == SCHEMA_VERSION
+        startup_timings.append(('check schema version', time.time() - started))
+
+        if not current:
+            started = time.time()
+            with new_engine.begin() as conn:
+                upgrade_schema(conn)
+            startup_timings.append(('create/upgrade schema', time.time() - started))
+        engine = new_engine
+    return engine
+
+
+def startup_report():
+    return "\n".join("%-24s %8.1f ms" % (step, seconds * 1000) for step, seconds in startup_timings)
 
-metadata.create_all(engine)
 
 UNCATEGORIZED = 'uncategorized'
 HOME = 'home'
@@ -95,15 +454,16 @@ category_pattern_map = {
     ENTERTAINMENT: ['netflix', 'amc', 'theater', 'theatre']
 }
 
-for c in category_pattern_map.keys():
-    if not engine.execute(select([categories.c.id]).where(categories.c.name == c)).fetchone():
-        engine.execute(categories.insert(), name=c)
 
-
-def exists(fitid):
-    stmt = select([xactions.c.id]).where(xactions.c.fitid == fitid)
-    fv = engine.execute(stmt).fetchone()
-    return fv
+def seed_categories(conn):
+    """
+    Add any category of category_pattern_map that isn't in the database yet, in one statement. This runs as part of
+    every schema upgrade, so a category added to the map reaches existing databases with the next migration.
+    """
+    existing = set(r[0] for r in conn.execute(select([categories.c.name])))
+    missing = [dict(name=c) for c in sorted(category_pattern_map) if c not in existing]
+    if missing:
+        conn.execute(categories.insert(), missing)
 
 
 def read_for_month_year(year, month):
@@ -117,46 +477,265 @@ def read_for_month_year(year, month):
     return read_txn_for_time(start, end)
 
 
-def read_txn_for_time(start_time, end_time, filter=None, only_new=False):
+@cached_read
+def read_txn_for_time(start_time, end_time, filter=None, load_id=None, after=None, limit=None, offset=None):
+    """
+    Transactions between start_time and end_time in (date, id) order. For paging, after is the (date, id) of the last
+    transaction of the previous page: the rows after it are found through the date index instead of skipping offset
+    rows one by one.
+    """
     logging.info("Reading transactions from %s to %s" % (str(start_time), str(end_time)))
     stmt = select(
-        [xactions.c.id, xactions.c.description, xactions.c.date, xactions.c.amount, categories.c.name, finins.c.nickname]).\
+        [xactions.c.id, xactions.c.description, xactions.c.date, xactions.c.amount_cents, categories.c.name, finins.c.nickname]).\
         where(xactions.c.date >= start_time). \
         where(xactions.c.date < end_time). \
         select_from(xactions.join(categories).join(finins))
 
-    if only_new:
-        stmt = stmt.where(xactions.c.new > 0)
+    if load_id:
+        stmt = stmt.where(xactions.c.load_id == load_id)
 
     if filter:
         filter_string = "%" + filter + "%"
-        stmt = stmt.where(or_(
-            categories.c.name.like(filter_string),
-            xactions.c.description.like(filter_string)))
+        fts_query = description_query(filter)
+        if fts_query and has_description_index():
+            description_match = text(
+                "transactions.id IN (SELECT rowid FROM transactions_fts WHERE transactions_fts MATCH :fts_query)",
+                bindparams=[bindparam('fts_query', fts_query)])
+        else:
+            description_match = xactions.c.description.like(filter_string)
+        stmt = stmt.where(or_(categories.c.name.like(filter_string), description_match))
+
+    if after is not None:
+        after_date, after_id = after
+        stmt = stmt.where(or_(xactions.c.date > after_date, and_(xactions.c.date == after_date, xactions.c.id > after_id)))
+
+    stmt = stmt.order_by(xactions.c.date, xactions.c.id)
+    if limit:
+        stmt = stmt.limit(limit)
+    if offset:
+        stmt = stmt.offset(offset)
+
+    return get_engine().execute(stmt)
+
+
+@cached_read
+def read_top_transactions(start_time, end_time, n):
+    """The n biggest expenses between start_time and end_time, biggest first."""
+    stmt = select(
+        [xactions.c.id, xactions.c.description, xactions.c.date, xactions.c.amount_cents, categories.c.name, finins.c.nickname]).\
+        where(xactions.c.date >= start_time). \
+        where(xactions.c.date < end_time). \
+        where(xactions.c.amount_cents < 0). \
+        select_from(xactions.join(categories).join(finins)). \
+        order_by(xactions.c.amount_cents, xactions.c.id). \
+        limit(n)
+    return get_engine().execute(stmt)
+
+
+@cached_read
+def read_top_descriptions(start_time, end_time, n):
+    """(description, count, total) of the n descriptions where most money went between start_time and end_time."""
+    total = func.sum(xactions.c.amount_cents)
+    stmt = select([xactions.c.description, func.count(xactions.c.id), total]). \
+        where(xactions.c.date >= start_time). \
+        where(xactions.c.date < end_time). \
+        group_by(xactions.c.description). \
+        having(total < 0). \
+        order_by(total). \
+        limit(n)
+    return get_engine().execute(stmt)
 
 
-    stmt = stmt.order_by(xactions.c.date)
+_description_index = None
 
-    return engine.execute(stmt)
 
+def has_description_index():
+    global _description_index
+    if _description_index is None:
+        _description_index = get_engine().dialect.name == 'sqlite' and get_engine().execute(
+            text("SELECT name FROM sqlite_master WHERE name = 'transactions_fts'")).fetchone() is not None
+    return _description_index
 
-def read_txn_for_time_by_category(start_time, end_time):
-    stmt = select([categories.c.name, func.sum(xactions.c.amount)]). \
-        where(xactions.c.date >= start_time). \
-        where(xactions.c.date < end_time). \
-        select_from(categories.outerjoin(xactions)). \
-        group_by(categories.c.name)\
+
+def description_query(filter):
+    """fts5 query matching descriptions that have words starting with every word in the filter."""
+    words = re.findall(r'\w+', filter, re.UNICODE)
+    return " ".join('"%s"*' % word for word in words)
 
 
-    return engine.execute(stmt)
+def whole_months(start_time, end_time):
+    """True when start_time and end_time are both the first of a month, so the monthly totals can answer for them."""
+    return start_time.day == 1 and end_time.day == 1
+
+
+def in_months(start_time, end_time):
+    """Picks the monthly_totals rows from the month of start_time up to, but not including, the month of end_time."""
+    period = monthly_totals.c.year * 12 + monthly_totals.c.month
+    return and_(monthly_totals.c.year >= start_time.year,
+                monthly_totals.c.year <= end_time.year,
+                period >= start_time.year * 12 + start_time.month,
+                period < end_time.year * 12 + end_time.month)
+
+
+@cached_read
+def read_txn_for_time_by_category(start_time, end_time):
+    """(category name, total) of every category with transactions between start_time and end_time, by name."""
+    totals = category_totals(start_time, end_time).alias('totals')
+    stmt = select([categories.c.name, totals.c.total]). \
+        select_from(categories.join(totals, totals.c.category_id == categories.c.id)). \
+        where(totals.c.count > 0). \
+        order_by(categories.c.name)
+    return get_engine().execute(stmt)
+
+
+def category_totals(start_time, end_time):
+    """(category_id, total, count) of every category with transactions between start_time and end_time."""
+    if not whole_months(start_time, end_time):
+        return select([xactions.c.category_id, func.sum(xactions.c.amount_cents).label('total'),
+                       func.count(xactions.c.id).label('count')]). \
+            where(xactions.c.date >= start_time). \
+            where(xactions.c.date < end_time). \
+            group_by(xactions.c.category_id)
+
+    return select([monthly_totals.c.category_id, func.sum(monthly_totals.c.total).label('total'),
+                   func.sum(monthly_totals.c.count).label('count')]). \
+        where(in_months(start_time, end_time)). \
+        group_by(monthly_totals.c.category_id)
+
+
+def category_tree():
+    """Recursive CTE pairing every category with itself and each of its descendants, a closure of parent_id."""
+    tree = select([categories.c.id.label('ancestor_id'), categories.c.id.label('category_id')]). \
+        cte('category_tree', recursive=True)
+    children = categories.alias('children')
+    return tree.union_all(select([tree.c.ancestor_id, children.c.id]).where(children.c.parent_id == tree.c.category_id))
+
+
+@cached_read
+def read_category_tree(start_time, end_time):
+    """
+    Every category with its parent_id and the budget, total and number of transactions between start_time and
+    end_time of it and all its sub-categories together. One query, however deep the tree.
+    """
+    tree = category_tree()
+    totals = category_totals(start_time, end_time).alias('totals')
+    ancestor = categories.alias('ancestor')
+    member = categories.alias('member')
+    stmt = select([ancestor.c.id, ancestor.c.name, ancestor.c.parent_id,
+                   func.coalesce(func.sum(member.c.budget), 0).label('budget'),
+                   func.coalesce(func.sum(totals.c.total), 0).label('total'),
+                   func.coalesce(func.sum(totals.c.count), 0).label('count')]). \
+        select_from(tree.join(ancestor, ancestor.c.id == tree.c.ancestor_id).
+                    join(member, member.c.id == tree.c.category_id).
+                    outerjoin(totals, totals.c.category_id == tree.c.category_id)). \
+        group_by(ancestor.c.id, ancestor.c.name, ancestor.c.parent_id)
+    return get_engine().execute(stmt)
+
+
+def week_start(column):
+    """The monday of the week column falls in, as a date."""
+    if get_engine().dialect.name == 'postgresql':
+        return cast(func.date_trunc('week', column), Date)
+    # 'weekday 0' moves forward to the sunday ending the week (or stays on it), 6 days before that is the monday.
+    return func.date(column, 'weekday 0', '-6 days')
+
+
+@cached_read
+def read_trend(start_time, end_time, category_id=None, weekly=False):
+    """
+    Totals per category and period between start_time and end_time, in a single grouped query. Returns a list of
+    (category name, period, total) where period is the first of the month, or the monday of the week when weekly.
+    Whole months are read from the monthly totals.
+    """
+    if weekly:
+        period = week_start(xactions.c.date)
+        stmt = select([categories.c.name, period, func.sum(xactions.c.amount_cents)]). \
+            where(xactions.c.date >= start_time). \
+            where(xactions.c.date < end_time). \
+            select_from(categories.join(xactions)). \
+            group_by(categories.c.name, period)
+        if category_id:
+            stmt = stmt.where(xactions.c.category_id == category_id)
+    elif not whole_months(start_time, end_time):
+        year = extract('year', xactions.c.date)
+        month = extract('month', xactions.c.date)
+        stmt = select([categories.c.name, year, month, func.sum(xactions.c.amount_cents)]). \
+            where(xactions.c.date >= start_time). \
+            where(xactions.c.date < end_time). \
+            select_from(categories.join(xactions)). \
+            group_by(categories.c.name, year, month)
+        if category_id:
+            stmt = stmt.where(xactions.c.category_id == category_id)
+    else:
+        stmt = select([categories.c.name, monthly_totals.c.year, monthly_totals.c.month,
+                       func.sum(monthly_totals.c.total)]). \
+            where(in_months(start_time, end_time)). \
+            select_from(categories.join(monthly_totals)). \
+            group_by(categories.c.name, monthly_totals.c.year, monthly_totals.c.month). \
+            having(func.sum(monthly_totals.c.count) > 0)
+        if category_id:
+            stmt = stmt.where(monthly_totals.c.category_id == category_id)
+
+    rows = []
+    for row in get_engine().execute(stmt):
+        if weekly:
+            # sqlite hands back the date function's result as text.
+            period = row[1]
+            if not isinstance(period, date):
+                period = date(*[int(part) for part in period.split('-')])
+            rows.append((row[0], period, int(row[2])))
+        else:
+            rows.append((row[0], date(int(row[1]), int(row[2]), 1), int(row[3])))
+    return rows
+
+
+def add_to_monthly_totals(conn, deltas):
+    """deltas maps (year, month, category_id, institution_id) to a [total, count] to add to that row."""
+    for (year, month, category_id, institution_id), (total, count) in deltas.items():
+        stmt = update(monthly_totals). \
+            where(monthly_totals.c.year == year). \
+            where(monthly_totals.c.month == month). \
+            where(monthly_totals.c.category_id == category_id). \
+            where(monthly_totals.c.institution_id == institution_id). \
+            values(total=monthly_totals.c.total + total, count=monthly_totals.c.count + count)
+        if conn.execute(stmt).rowcount == 0:
+            conn.execute(monthly_totals.insert(), year=year, month=month, category_id=category_id,
+                         institution_id=institution_id, total=total, count=count)
+
+
+def rebuild_monthly_totals(conn=None):
+    if conn is None:
+        with get_engine().begin() as conn:
+            return rebuild_monthly_totals(conn)
+
+    year = extract('year', xactions.c.date)
+    month = extract('month', xactions.c.date)
+    totals = select([year, month, xactions.c.category_id, xactions.c.institution_id,
+                     func.sum(xactions.c.amount_cents), func.count(xactions.c.id)]). \
+        group_by(year, month, xactions.c.category_id, xactions.c.institution_id)
+
+    conn.execute(monthly_totals.delete())
+    conn.execute(monthly_totals.insert().from_select(
+        ['year', 'month', 'category_id', 'institution_id', 'total', 'count'], totals))
 
 
 def find_institution_id(name, fid):
     stmt = select([finins.c.id]).where(finins.c.name == name.strip()).where(finins.c.fid == int(fid))
-    account_id = engine.execute(stmt).fetchone()
+    account_id = get_engine().execute(stmt).fetchone()
+
+    if not account_id:
+        res = get_engine().execute(finins.insert(), name=name.strip(), fid=fid)
+        return res.inserted_primary_key[0]
+    else:
+        return account_id[0]
+
+
+def find_institution_by_nickname(nickname):
+    stmt = select([finins.c.id]).where(finins.c.nickname == nickname)
+    account_id = get_engine().execute(stmt).fetchone()
 
     if not account_id:
-        res = engine.execute(finins.insert(), name=name.strip(), fid=fid)
+        res = get_engine().execute(finins.insert(), nickname=nickname, name=nickname)
         return res.inserted_primary_key[0]
     else:
         return account_id[0]
@@ -165,137 +744,507 @@ def find_institution_id(name, fid):
 def find_category_id(name):
     stmt = select([categories.c.id]).where(categories.c.name.like('%' + name + '%'))
     try:
-        return engine.execute(stmt).fetchone()[0]
+        return get_engine().execute(stmt).fetchone()[0]
     except:
         return None
 
 
 def load_categories():
-    rows = engine.execute(select([categories]))
+    rows = get_engine().execute(select([categories]))
     category_map = {}
     for r in rows:
         category_map[r['name'].lower()] = r['id']
     return category_map
 
 def load_desc_category():
-    rows = engine.execute(select([description_category_mapping]))
+    rows = get_engine().execute(select([description_category_mapping]))
     desc_category_map = {}
     for r in rows:
         desc_category_map[r['description']] = r['category_id']
     return desc_category_map
 
 
+INSERT_CHUNK_SIZE = 500
+
+
+class IngestResult(object):
+    """What happened to the transactions handed to insert_transactions."""
+
+    def __init__(self):
+        self.inserted = 0
+        self.skipped = 0
+        self.earliest = None
+        self.newest = None
+
+    def add(self, dt):
+        self.inserted += 1
+        if self.earliest is None or dt < self.earliest:
+            self.earliest = dt
+        if self.newest is None or dt > self.newest:
+            self.newest = dt
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def insert_transactions(institution_id, transactions, categories_map, desc_category_map, load_id=None):
+    """
+    Insert parsed transactions (dicts with date, description, amount_cents and fitid) in one database transaction,
+    as part of the given load.
+    Fitids already loaded for the institution are looked up a chunk at a time and skipped, the rest go in with a
+    single executemany per chunk. On PostgreSQL the rows are streamed in with COPY instead, see copy_transactions.
+    """
+    if get_engine().dialect.name == 'postgresql':
+        return copy_transactions(institution_id, transactions, categories_map, desc_category_map, load_id)
+
+    result = IngestResult()
+    seen = set()
+    deltas = {}
+    insert = xactions.insert()
+    if get_engine().dialect.name == 'sqlite':
+        # the unique (institution_id, fitid) index catches anything a concurrent load inserted after our lookup.
+        insert = insert.prefix_with('OR IGNORE')
+
+    with get_engine().begin() as conn:
+        for chunk in chunks(transactions, INSERT_CHUNK_SIZE):
+            candidates = [tx for tx in chunk if len(tx) == 4]
+            result.skipped += len(chunk) - len(candidates)
+
+            fitids = set(tx['fitid'] for tx in candidates)
+            if fitids:
+                stmt = select([xactions.c.fitid]). \
+                    where(xactions.c.institution_id == institution_id). \
+                    where(xactions.c.fitid.in_(fitids))
+                seen.update(row[0] for row in conn.execute(stmt))
+
+            rows = []
+            for tx in candidates:
+                if tx['fitid'] in seen:
+                    result.skipped += 1
+                    continue
+                seen.add(tx['fitid'])
+                rows.append(dict(institution_id=institution_id,
+                                 date=tx['date'],
+                                 description=tx['description'],
+                                 amount_cents=tx['amount_cents'],
+                                 load_id=load_id,
+                                 fitid=tx['fitid']))
+                result.add(tx['date'])
+
+            category_ids = categorize([row['description'] for row in rows], categories_map, desc_category_map)
+            for row, category_id in zip(rows, category_ids):
+                row['category_id'] = category_id
+
+            if rows:
+                res = conn.execute(insert, rows)
+                if 0 <= res.rowcount < len(rows):
+                    result.inserted -= len(rows) - res.rowcount
+                    result.skipped += len(rows) - res.rowcount
+                    # we can't tell which rows were dropped, so the totals are recomputed below.
+                    deltas = None
+
+            if deltas is not None:
+                for row in rows:
+                    delta = deltas.setdefault(
+                        (row['date'].year, row['date'].month, row['category_id'], institution_id), [0, 0])
+                    delta[0] += row['amount_cents']
+                    delta[1] += 1
+
+        if deltas is None:
+            rebuild_monthly_totals(conn)
+        else:
+            add_to_monthly_totals(conn, deltas)
+
+    return result
+
+
+COPY_COLUMNS = ('institution_id', 'category_id', 'date', 'description', 'amount_cents', 'load_id', 'fitid')
+
+
+class CopyStream(object):
+    """File like object over an iterator of lines, for psycopg2's copy_expert to read from."""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.buf = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            try:
+                self.buf += next(self.lines)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buf = self.buf, ''
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    value = value.encode('utf-8') if isinstance(value, unicode) else str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def raw_execute(conn, cursor, statement, run=None):
+    """
+    Run statement on cursor, a DBAPI cursor of conn, or call run() to do it. The cursor execute events are fired
+    around it as if it had gone through conn, so the profiler times it like any other statement.
+    """
+    conn.dispatch.before_cursor_execute(conn, cursor, statement, None, None, False)
+    if run is None:
+        cursor.execute(statement)
+    else:
+        run()
+    conn.dispatch.after_cursor_execute(conn, cursor, statement, None, None, False)
+
+
+def copy_transactions(institution_id, transactions, categories_map, desc_category_map, load_id=None):
+    """
+    PostgreSQL bulk ingest: the parsed transactions are categorized a chunk at a time and streamed with COPY into a
+    temporary staging table, then merged into transactions in one INSERT ... SELECT that leaves out fitids the
+    institution already has. Needs PostgreSQL 9.5 or later for ON CONFLICT.
+    """
+    result = IngestResult()
+    staged = [0]
+
+    def lines():
+        for chunk in chunks(transactions, INSERT_CHUNK_SIZE):
+            candidates = [tx for tx in chunk if len(tx) == 4]
+            result.skipped += len(chunk) - len(candidates)
+            category_ids = categorize([tx['description'] for tx in candidates], categories_map, desc_category_map)
+            for tx, category_id in zip(candidates, category_ids):
+                staged[0] += 1
+                values = (institution_id, category_id, tx['date'].strftime('%Y-%m-%d'), tx['description'],
+                          tx['amount_cents'], load_id, tx['fitid'])
+                yield '\t'.join(copy_value(v) for v in values) + '\n'
+
+    columns = ", ".join(COPY_COLUMNS)
+    with get_engine().begin() as conn:
+        cursor = conn.connection.cursor()
+        raw_execute(conn, cursor, "CREATE TEMPORARY TABLE transactions_staging (institution_id integer, "
+                    "category_id integer, date date, description varchar, amount_cents integer, load_id integer, "
+                    "fitid varchar) ON COMMIT DROP")
+        copy = "COPY transactions_staging (%s) FROM STDIN" % columns
+        raw_execute(conn, cursor, copy, lambda: cursor.copy_expert(copy, CopyStream(lines())))
+        raw_execute(conn, cursor, "INSERT INTO transactions (%s) SELECT %s FROM transactions_staging "
+                    "ON CONFLICT (institution_id, fitid) DO NOTHING "
+                    "RETURNING date, category_id, amount_cents" % (columns, columns))
+
+        deltas = {}
+        for dt, category_id, amount_cents in cursor:
+            result.add(dt)
+            delta = deltas.setdefault((dt.year, dt.month, category_id, institution_id), [0, 0])
+            delta[0] += amount_cents
+            delta[1] += 1
+        cursor.close()
+        result.skipped += staged[0] - result.inserted
+        # the writes above went around the engine, tell the query cache about them here rather than leaning on the
+        # checkin after the commit.
+        query_cache.changed()
+
+        add_to_monthly_totals(conn, deltas)
+
+    return result
+
+
 def insert_transaction(institution_id, categories_map, desc_category_map, **kwargs):
     if len(kwargs) != 4:
         return
 
-    skip = exists(kwargs['fitid'])
+    return insert_transactions(institution_id, [kwargs], categories_map, desc_category_map).inserted == 1
 
-    if skip:
-        return False
 
-    dt = kwargs['date']
-    description = kwargs['description']
-    amount = kwargs['amount']
-
-    engine.execute(xactions.insert(),
-                   institution_id=institution_id,
-                   category_id=guess_category(description, categories_map, desc_category_map),
-                   date=dt,
-                   description=description,
-                   amount=amount,
-                   new=1,
-                   fitid=kwargs['fitid'])
-    return True
+def insert_category(category_name, parent_id=None):
+    get_engine().execute(categories.insert(), name=category_name, parent_id=parent_id)
+    reset_matcher()
 
 
-def insert_category(category_name):
-    engine.execute(categories.insert(), name=category_name)
+def set_category_parent(category_id, parent_id):
+    """
+    Make category_id a sub-category of parent_id, or a top level one when parent_id is None. Returns False, and
+    changes nothing, when parent_id is category_id itself or one of its sub-categories.
+    """
+    parents = dict((row[0], row[1]) for row in get_engine().execute(select([categories.c.id, categories.c.parent_id])))
+    ancestor = parent_id
+    while ancestor is not None:
+        if ancestor == category_id:
+            return False
+        ancestor = parents.get(ancestor)
+    get_engine().execute(update(categories).where(categories.c.id == category_id).values(parent_id=parent_id))
+    return True
 
 def update_category(category_name, budget):
     category_id = find_category_id(category_name)
     if category_id:
         stmt = update(categories).where(categories.c.id == category_id).values(budget=budget)
-        upd = engine.execute(stmt)
+        upd = get_engine().execute(stmt)
         return upd.rowcount
     else:
         return 0
 
+# compiled from category_pattern_map and the category_patterns table, thrown away whenever either could change.
+_matcher = None
+
+
+def category_rules(categories_map):
+    """
+    (pattern, category_id, priority) rules in priority order: user defined patterns first, highest priority first,
+    then the built in ones, which have a priority of None and lose to any user defined pattern.
+    """
+    stmt = select([category_patterns.c.pattern, category_patterns.c.category_id,
+                   func.coalesce(category_patterns.c.priority, 0)]). \
+        order_by(func.coalesce(category_patterns.c.priority, 0).desc(), category_patterns.c.id)
+    rules = [(r[0], r[1], r[2]) for r in get_engine().execute(stmt)]
+
+    for category_name in sorted(category_pattern_map):
+        for pattern in category_pattern_map[category_name]:
+            rules.append((pattern, categories_map[category_name], None))
+    return rules
+
+
+def get_matcher(categories_map):
+    global _matcher
+    if _matcher is None:
+        _matcher = CategoryMatcher(category_rules(categories_map))
+    return _matcher
+
+
+def reset_matcher():
+    global _matcher
+    _matcher = None
+
+
+def add_category_pattern(category_id, pattern, priority=0):
+    get_engine().execute(category_patterns.insert(), category_id=category_id, pattern=clean_description(pattern),
+                   priority=priority)
+    reset_matcher()
+
+
 def guess_category(description, categories_map, desc_category_mapping):
-    cleaned_description = clean_description(description)
-    if cleaned_description in desc_category_mapping:
-        return desc_category_mapping[cleaned_description]
+    return categorize([description], categories_map, desc_category_mapping)[0]
+
+
+def categorize(descriptions, categories_map, desc_category_mapping):
+    """Category ids for a list of descriptions. Each distinct description is only matched once."""
+    matcher = get_matcher(categories_map)
+    uncategorized = categories_map[UNCATEGORIZED]
+    guesses = {}
+    category_ids = []
 
-    for category_name in category_pattern_map:
-        possible_patterns = category_pattern_map[category_name]
-        for pattern in possible_patterns:
-            # Use regexp (\bpattern\b) instead of just string contains.
-            if pattern in cleaned_description:
-                return categories_map[category_name]
+    for description in descriptions:
+        cleaned_description = clean_description(description)
+        category_id = guesses.get(cleaned_description)
+        if category_id is None:
+            category_id = desc_category_mapping.get(cleaned_description)
+            if category_id is None:
+                category_id = matcher.match(cleaned_description) or uncategorized
+            guesses[cleaned_description] = category_id
+        category_ids.append(category_id)
 
-    return categories_map[UNCATEGORIZED]
+    return category_ids
 
 
+@cached_read
 def list_categories():
-    return engine.execute(select([categories]).order_by(categories.c.budget, categories.c.name))
+    return get_engine().execute(select([categories]).order_by(categories.c.budget, categories.c.name))
 
 
+@cached_read
 def list_institutions():
-    return engine.execute(select([finins.c.id, finins.c.nickname, finins.c.name, finins.c.fid]))
+    return get_engine().execute(select([finins.c.id, finins.c.nickname, finins.c.name, finins.c.fid]))
 
 
 def update_tx_category(txid, category_id):
-    stmt = update(xactions).where(xactions.c.id == txid).values(category_id=category_id)
-    upd = engine.execute(stmt)
+    return update_tx_categories([txid], category_id)
+
+
+def update_tx_categories(txids, category_id):
+    """
+    Move the given transactions to category_id and remember that category for their descriptions, all in one
+    database transaction. Returns how many of the transactions were found.
+    """
+    with get_engine().begin() as conn:
+        rows = []
+        for chunk in chunks(txids, INSERT_CHUNK_SIZE):
+            stmt = select([xactions.c.id, xactions.c.description, xactions.c.category_id, xactions.c.institution_id,
+                           xactions.c.date, xactions.c.amount_cents]).where(xactions.c.id.in_(chunk))
+            rows.extend(conn.execute(stmt).fetchall())
+
+        move_transactions(conn, [(tx, category_id) for tx in rows])
+        update_description_mappings(dict((clean_description(tx['description']), category_id) for tx in rows), conn)
+        return len(rows)
+
+
+def recategorize(only_uncategorized=False):
+    """
+    Categorize the transactions already loaded again, with the current description mappings and pattern rules, the
+    way an import would. Returns (transactions looked at, transactions that changed category).
+    """
+    categories_map = load_categories()
+    desc_category_map = load_desc_category()
+    uncategorized = categories_map[UNCATEGORIZED]
+
+    with get_engine().begin() as conn:
+        stmt = select([xactions.c.id, xactions.c.description, xactions.c.category_id, xactions.c.institution_id,
+                       xactions.c.date, xactions.c.amount_cents])
+        if only_uncategorized:
+            stmt = stmt.where(or_(xactions.c.category_id == uncategorized, xactions.c.category_id == None))
+        rows = conn.execute(stmt).fetchall()
+
+        category_ids = categorize([tx['description'] for tx in rows], categories_map, desc_category_map)
+        moved = move_transactions(conn, zip(rows, category_ids))
+    return len(rows), moved
+
+
+def move_transactions(conn, moves):
+    """
+    moves is a list of (transaction, category id) where the transaction has id, category_id, institution_id, date and
+    amount_cents. Sends one UPDATE per category (and chunk of ids) and keeps the monthly totals in step. Transactions
+    already in their category are left alone. Returns how many were moved.
+    """
+    ids_by_category = {}
+    deltas = {}
+    for tx, category_id in moves:
+        if tx['category_id'] == category_id:
+            continue
+        ids_by_category.setdefault(category_id, []).append(tx['id'])
+        year, month = tx['date'].year, tx['date'].month
+        for key, sign in (((year, month, tx['category_id'], tx['institution_id']), -1),
+                          ((year, month, category_id, tx['institution_id']), 1)):
+            delta = deltas.setdefault(key, [0, 0])
+            delta[0] += sign * tx['amount_cents']
+            delta[1] += sign
+
+    for category_id, ids in ids_by_category.items():
+        for chunk in chunks(ids, INSERT_CHUNK_SIZE):
+            conn.execute(update(xactions).where(xactions.c.id.in_(chunk)).values(category_id=category_id))
+    add_to_monthly_totals(conn, deltas)
+    return sum(len(ids) for ids in ids_by_category.values())
+
+
+def update_description_mapping(desc, category_id, conn=None):
+    update_description_mappings({clean_description(desc): category_id}, conn)
+
+
+def update_description_mappings(mapping, conn=None):
+    """Remember the category for each (cleaned) description in mapping, replacing the one remembered before."""
+    conn = conn or get_engine()
+    mappings = description_category_mapping
+    known = set()
+    for chunk in chunks(sorted(mapping), INSERT_CHUNK_SIZE):
+        stmt = select([mappings.c.description]).where(mappings.c.description.in_(chunk))
+        known.update(row[0] for row in conn.execute(stmt))
+
+    descriptions_by_category = {}
+    for description in known:
+        descriptions_by_category.setdefault(mapping[description], []).append(description)
+    for category_id, descriptions in descriptions_by_category.items():
+        for chunk in chunks(descriptions, INSERT_CHUNK_SIZE):
+            conn.execute(update(mappings).where(mappings.c.description.in_(chunk)).values(category_id=category_id))
+
+    new = [{'description': d, 'category_id': mapping[d]} for d in sorted(mapping) if d not in known]
+    if new:
+        conn.execute(mappings.insert(), new)
 
-    if upd.rowcount == 1:
-        stmt = select([xactions.c.description]).where(xactions.c.id == txid)
-        desc = engine.execute(stmt).fetchone()
-        update_description_mapping(desc[0], category_id)
-    return upd.rowcount
-
-
-def update_description_mapping(desc, category_id):
-    cleaned_desc = desc.strip().lower()
-    stmt = select([description_category_mapping.c.id]).where(description_category_mapping.c.description == cleaned_desc)
-
-    if not engine.execute(stmt).fetchone():
-        engine.execute(description_category_mapping.insert(), description=cleaned_desc, category_id=category_id)
-    else:
-        stmt = update(description_category_mapping).where(description_category_mapping.c.description == cleaned_desc).values(category_id=category_id)
-        engine.execute(stmt)
 
 def clean_description(desc):
     return desc.strip().lower()
 
 def create_institution(name, type):
     print("called create institution")
-    engine.execute(finins.insert(), name=name, type=type)
+    get_engine().execute(finins.insert(), name=name, type=type)
 
 
-def need_to_load(file, stat):
-    if "qfx" not in file.lower():
-        return False
+def is_statement(file):
+    return "qfx" in file.lower()
 
-    stmt = select([files_loaded])
-    loaded_files = engine.execute(stmt)
 
-    for loaded_file in loaded_files:
-        if loaded_file['name'] == file and int(loaded_file['mtime']) == int(stat.st_mtime):
+def need_to_load(file, stat):
+    """
+    A file is skipped when a file of the same name, size and mtime was loaded before, or, failing that, when a file
+    with the same contents was (a statement downloaded twice).
+    """
+    stmt = select([files_loaded.c.mtime, files_loaded.c.size]).where(files_loaded.c.name == file)
+    for mtime, size in get_engine().execute(stmt):
+        if int(mtime) == int(stat.st_mtime) and (size is None or size == stat.st_size):
             return False
 
+    digest = file_digest(file, stat)
+    stmt = select([files_loaded.c.id]).where(files_loaded.c.md5 == digest)
+    if get_engine().execute(stmt).fetchone():
+        # remember this copy too, so the next scan doesn't have to read it again.
+        file_loaded(file, stat)
+        return False
+
     return True
 
 
-def file_loaded(file, stat):
-    engine.execute(files_loaded.insert(), name=file, mtime=int(stat.st_mtime))
+# md5 of the files checked by need_to_load, keyed by (name, size, mtime) so a file is read at most once between
+# checking and recording it. file_loaded drops them again, the watcher would otherwise keep one per download forever.
+_digests = {}
+
+
+def file_digest(file, stat):
+    key = (file, stat.st_size, int(stat.st_mtime))
+    if key not in _digests:
+        md5 = hashlib.md5()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                md5.update(block)
+        _digests[key] = md5.hexdigest()
+    return _digests[key]
+
+
+def file_loaded(file, stat, load_id=None):
+    get_engine().execute(files_loaded.insert(), name=file, mtime=int(stat.st_mtime), size=stat.st_size,
+                         md5=file_digest(file, stat), load_id=load_id)
+    _digests.pop((file, stat.st_size, int(stat.st_mtime)), None)
 
 
 def update_institution(id, nickname):
     stmt = update(finins).where(finins.c.id == id).values(nickname=nickname)
-    engine.execute(stmt)
+    get_engine().execute(stmt)
+
+
+def start_load(source):
+    """Record the start of an import from source (a directory or a file) and return its id."""
+    res = get_engine().execute(loads.insert(), started=datetime.now(), source=source)
+    return res.inserted_primary_key[0]
+
+
+def latest_load_id():
+    return get_engine().execute(select([func.max(loads.c.id)])).scalar()
+
+
+@cached_read
+def list_loads():
+    """Every load, oldest first, with the number of transactions and files it brought in."""
+    transaction_counts = select([xactions.c.load_id, func.count(xactions.c.id).label('transactions')]). \
+        group_by(xactions.c.load_id).alias()
+    file_counts = select([files_loaded.c.load_id, func.count(files_loaded.c.id).label('files')]). \
+        group_by(files_loaded.c.load_id).alias()
+    stmt = select([loads.c.id, loads.c.started, loads.c.source, transaction_counts.c.transactions,
+                   file_counts.c.files]). \
+        select_from(loads.outerjoin(transaction_counts, transaction_counts.c.load_id == loads.c.id).
+                    outerjoin(file_counts, file_counts.c.load_id == loads.c.id)). \
+        order_by(loads.c.id)
+    return get_engine().execute(stmt)
+
 
+@cached_read
+def list_load_files(load_id):
+    stmt = select([files_loaded.c.name]).where(files_loaded.c.load_id == load_id).order_by(files_loaded.c.name)
+    return [row[0] for row in get_engine().execute(stmt)]
 
-def clear_last_load():
-    stmt = update(xactions).values(new=0)
-    engine.execute(stmt)
\ No newline at end of file
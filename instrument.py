@@ -0,0 +1,117 @@
+"""
+Per command timing and SQL statistics for the thyme REPL.
+
+Statements are timed with SQLAlchemy cursor execute events and fetched rows are counted as SQLAlchemy hands them
+out. Nothing is hooked in until a Profiler is first enabled, and the hooks do nothing while it is disabled.
+"""
+import re
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.result import ResultProxy
+
+
+class CommandStats(object):
+    """What running one command cost."""
+
+    def __init__(self, command):
+        self.command = command
+        self.started = time.time()
+        self.wall_time = 0.0
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.timings = []
+
+    def slowest(self, n):
+        return sorted(self.timings, reverse=True)[:n]
+
+    def report(self, n):
+        lines = ["%s: %.1f ms, %d statements, %.1f ms in the database, %d rows fetched" % (
+            self.command, self.wall_time * 1000, self.statements, self.db_time * 1000, self.rows)]
+        for seconds, statement in self.slowest(n):
+            lines.append("  %8.1f ms  %s" % (seconds * 1000, statement))
+        return "\n".join(lines)
+
+
+class Profiler(object):
+    SLOWEST = 3
+    STATEMENT_WIDTH = 100
+
+    def __init__(self):
+        self.enabled = False
+        self.current = None
+        self.history = []
+        self._listening = False
+        self._process_rows = None
+
+    def enable(self):
+        if self.enabled:
+            return
+        if not self._listening:
+            event.listen(Engine, 'before_cursor_execute', self.before_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_execute)
+            self._listening = True
+
+        self._process_rows = ResultProxy.process_rows
+        profiler = self
+        original = self._process_rows
+
+        def process_rows(result, rows):
+            rows = original(result, rows)
+            if profiler.current is not None:
+                profiler.current.rows += len(rows)
+            return rows
+
+        ResultProxy.process_rows = process_rows
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        ResultProxy.process_rows = self._process_rows
+        self.enabled = False
+
+    def start(self, command):
+        if self.enabled:
+            self.current = CommandStats(command)
+
+    def finish(self):
+        """Close the statistics for the running command and return them, None if timing is off."""
+        stats = self.current
+        if stats is not None:
+            stats.wall_time = time.time() - stats.started
+            self.history.append(stats)
+            self.current = None
+        return stats
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.current is not None:
+            conn.info.setdefault('thyme_started', []).append(time.time())
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.current is not None and conn.info.get('thyme_started'):
+            seconds = time.time() - conn.info['thyme_started'].pop()
+            self.current.statements += 1
+            self.current.db_time += seconds
+            self.current.timings.append((seconds, self.shorten(statement)))
+
+    def shorten(self, statement):
+        statement = re.sub(r'\s+', ' ', statement).strip()
+        if len(statement) > self.STATEMENT_WIDTH:
+            statement = statement[:self.STATEMENT_WIDTH - 3] + '...'
+        return statement
+
+    def summary(self):
+        """One line per command name (list, bycat, ...) with the totals of every time it ran."""
+        totals = {}
+        for stats in self.history:
+            name = stats.command.split()[0] if stats.command.strip() else stats.command
+            total = totals.setdefault(name, [0, 0.0, 0, 0.0, 0])
+            total[0] += 1
+            total[1] += stats.wall_time
+            total[2] += stats.statements
+            total[3] += stats.db_time
+            total[4] += stats.rows
+        return sorted(totals.items())
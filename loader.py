@@ -1,83 +1,280 @@
 import csv
 import argparse
-from parser import parsers
+import hashlib
+from parser import get_parser
 import db
 import os
+import multiprocessing
+import threading
+import time
+from fnmatch import fnmatch
 from os.path import expanduser
-from bs4 import BeautifulSoup
-from datetime import date, datetime
+import config
+import qfx
+
+
+def say(message):
+    print(message)
 
 
 def load_xactions(**kwargs):
     reader = csv.reader(kwargs['file'], delimiter=',', quotechar='"')
-    csv_parser = parsers[kwargs['parser']]
-    inst = kwargs['institution']
+    csv_parser = get_parser(kwargs['parser'])
 
-    institution_id = db.find_institution_id(inst)
+    institution_id = db.find_institution_by_nickname(kwargs['institution'])
     categories_map = db.load_categories()
+    desc_category_map = db.load_desc_category()
+
+    load_id = kwargs.get('load_id') or db.start_load(getattr(kwargs['file'], 'name', None))
+    result = db.insert_transactions(institution_id, csv_transactions(reader, csv_parser), categories_map,
+                                    desc_category_map, load_id)
+    report = kwargs.get('report', say)
+    report("{0}/{1} transactions imported".format(result.inserted, result.inserted + result.skipped))
+    return result
+
+
+def csv_target(file):
+    """
+    (parser, institution) for a csv export, going by the "watch_csv" section of the config file, which maps file
+    name patterns to them, e.g.
+
+        "watch_csv": {"stmt*.csv": {"parser": "bofa", "institution": "bofa"}}
+
+    None if the file isn't one of those.
+    """
+    name = os.path.basename(file)
+    for pattern, target in sorted(config.get('watch_csv', {}).items()):
+        if fnmatch(name, pattern):
+            return target['parser'], target['institution']
+    return None
+
 
-    count = 0
+def load_csv(file, load_id=None, report=say):
+    """Load a csv export that csv_target knows about, and remember the file like a statement. Returns the load id."""
+    parser, institution = csv_target(file)
+    load_id = load_id or db.start_load(file)
+    with open(file) as f:
+        load_xactions(file=f, parser=parser, institution=institution, load_id=load_id,
+                      report=lambda message: report("{0}: {1}".format(file, message)))
+    db.file_loaded(file, os.stat(file), load_id)
+    return load_id
+
+
+def csv_transactions(reader, csv_parser):
+    """
+    Parse csv rows into transactions as they are read, dropping rows that don't parse (headers and such). Bank CSVs
+    don't carry a fitid, so one is made up from the row. Identical rows (two coffees on the same day) are told apart
+    by how many times the row was seen so far, which keeps reloading the same file idempotent.
+    """
+    occurrences = {}
     for row in reader:
-        parsed_row = csv_parser.parse(row)
-        count += 1
-        db.insert_transaction(institution_id[0], categories_map, **parsed_row)
-    print(count)
+        tx = csv_parser.parse(row)
+        if not tx:
+            continue
+        key = "%s|%s|%.2f" % (tx['date'].date(), tx['description'].strip(), tx['amount_cents'] / 100.0)
+        occurrences[key] = occurrences.get(key, 0) + 1
+        tx['fitid'] = "csv-" + hashlib.md5("%s|%d" % (key, occurrences[key])).hexdigest()[:24]
+        yield tx
 
 
 def load_qfx(**kwargs):
-    soup = BeautifulSoup(open(kwargs['file']))
+    load_id = kwargs.get('load_id') or db.start_load(kwargs['file'])
+    with open(kwargs['file']) as f:
+        reader = qfx.QfxReader(f)
+        org, fid = reader.header()
+        return store_qfx(kwargs['file'], org, fid, reader, load_id=load_id)
+
+
+def parse_qfx(file):
+    """Parse a whole statement into (org, fid, transactions). This is the part load_qfx_new farms out to workers."""
+    with open(file) as f:
+        reader = qfx.QfxReader(f)
+        org, fid = reader.header()
+        return org, fid, list(reader)
+
 
-    account_id = db.find_institution_id(soup.find("org").contents[0], soup.find("org").find("fid").contents[0])
+def store_qfx(file, org, fid, transactions, report=say, load_id=None):
+    account_id = db.find_institution_id(org, fid)
 
     categories_map = db.load_categories()
     desc_category_map = db.load_desc_category()
 
-    total_inserted = 0
-    total = 0
-
-    earliest_date = datetime.today()
-    newest_date = datetime(2007, 1, 1)
-
-    for tx in soup.find_all("stmttrn"):
-        total += 1
-        # some qfx files have dates in the form: 20131207000000.000[-7:MST]
-        txn_date = datetime.strptime(tx.find('dtposted').contents[0].strip()[:14], "%Y%m%d%H%M%S")
-        tx_amount = float(tx.find('trnamt').contents[0].strip())
-        tx_description = tx.find('name').contents[0].strip()
-        tx_fitid = tx.find('fitid').contents[0].strip()
-        inserted = db.insert_transaction(account_id, categories_map, desc_category_map, date=txn_date,
-                                         amount=tx_amount, description=tx_description, fitid=tx_fitid)
-
-        if inserted:
-            total_inserted += 1
-            if txn_date < earliest_date:
-                earliest_date = txn_date
-            if txn_date > newest_date:
-                newest_date = txn_date
-
-    db.file_loaded(kwargs['file'], os.stat(kwargs['file']))
-
-    if total_inserted > 0:
-        print("{0}/{1} transactions from {2} to {3} imported from {4}".format(
-            total_inserted, total, earliest_date.date(), newest_date.date(), kwargs['file']))
+    result = db.insert_transactions(account_id, transactions, categories_map, desc_category_map, load_id)
+
+    db.file_loaded(file, os.stat(file), load_id)
+
+    total = result.inserted + result.skipped
+    if result.inserted > 0:
+        report("{0}/{1} transactions from {2:%Y-%m-%d} to {3:%Y-%m-%d} imported from {4}".format(
+            result.inserted, total, result.earliest, result.newest, file))
     else:
-        print("{0}/{1} transactions imported from {2}".format(total_inserted, total, kwargs['file']))
+        report("{0}/{1} transactions imported from {2}".format(result.inserted, total, file))
+    return result
 
 
-def load_qfx_new(dir=None):
+def new_statements(dir=None):
+    """The statements in dir (~/Downloads by default) that haven't been loaded yet, in name order."""
     if not dir:
         dir = expanduser("~") + "/Downloads"
 
     files = []
-    for file in os.listdir(dir):
+    for file in sorted(os.listdir(dir)):
+        if not db.is_statement(file):
+            continue
         fullpath = dir + "/" + file
         if db.need_to_load(fullpath, os.stat(fullpath)):
             files.append(fullpath)
+    return files
+
+
+def load_files(files, jobs=1, job=None):
+    """
+    Load the given statements as one load. With jobs > 1 the files are parsed by a pool of processes while this
+    process stays the only one writing to the database. Files are always stored, and reported, in name order. A
+    LoadJob, when given, is kept up to date with the progress and can stop the load between two transactions.
+    Returns the id of the load, None if there was nothing to load.
+    """
+    job = job or LoadJob(files, jobs)
+    if not files:
+        return None
+    if job.load_id is None:
+        job.load_id = db.start_load(os.path.dirname(files[0]))
+    if jobs > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(files)))
+        try:
+            for f, (org, fid, transactions) in zip(files, pool.imap(parse_qfx, files)):
+                job.store(f, org, fid, transactions)
+        finally:
+            if job.cancelled.is_set():
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+    else:
+        for f in files:
+            with open(f) as fileobj:
+                reader = qfx.QfxReader(fileobj)
+                org, fid = reader.header()
+                job.store(f, org, fid, reader)
+    return job.load_id
+
+
+def load_qfx_new(dir=None, jobs=1):
+    """Load every statement in dir (~/Downloads by default) that hasn't been loaded yet."""
+    return load_files(new_statements(dir), jobs)
+
+
+class LoadCancelled(Exception):
+    pass
+
+
+class LoadJob(threading.Thread):
+    """
+    Loads statements on a background thread, so the REPL stays usable in the meantime.
+
+        job = LoadJob(new_statements(), jobs=2)
+        job.start()
+        print(job.status())
+        job.cancel()
+
+    Every file is stored in its own database transaction, so other commands see a file either completely or not at
+    all. Cancelling rolls back the file being loaded; files stored before it stay loaded. Messages are kept in
+    job.messages instead of being printed over the prompt.
+    """
+
+    def __init__(self, files, jobs=1):
+        threading.Thread.__init__(self, name='thyme-load')
+        self.daemon = True
+        self.files = files
+        self.jobs = jobs
+        self.load_id = None
+        self.total_bytes = sum(os.path.getsize(f) for f in files)
+        self.done_bytes = 0
+        self.files_done = 0
+        self.rows = 0
+        self.inserted = 0
+        self.current = None
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.cancelled = threading.Event()
+        self.messages = []
+        self.lock = threading.Lock()
+        self.report = say
+
+    def run(self):
+        self.started = time.time()
+        self.report = self.add_message
+        try:
+            load_files(self.files, self.jobs, self)
+        except LoadCancelled:
+            self.add_message("load cancelled, {0} of {1} files were loaded".format(self.files_done, len(self.files)))
+        except Exception as e:
+            self.error = e
+            self.add_message("load failed on {0}: {1}".format(self.current, e))
+        finally:
+            self.current = None
+            self.finished = time.time()
+
+    def store(self, file, org, fid, transactions):
+        if self.started is None:
+            self.started = time.time()
+        self.check()
+        self.current = file
+        result = store_qfx(file, org, fid, self.track(transactions), self.report, self.load_id)
+        self.inserted += result.inserted
+        self.files_done += 1
+        self.done_bytes += os.path.getsize(file)
+        return result
+
+    def track(self, transactions):
+        for tx in transactions:
+            self.check()
+            self.rows += 1
+            yield tx
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise LoadCancelled()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def eta(self):
+        """Seconds until the load is done, guessed from the bytes loaded so far. None until the first file is in."""
+        if not self.done_bytes or self.finished:
+            return None
+        return self.elapsed() * (self.total_bytes - self.done_bytes) / self.done_bytes
 
-    for f in files:
-        load_qfx(file=f)
+    def status(self):
+        elapsed = self.elapsed()
+        rate = self.rows / elapsed if elapsed else 0.0
+        if self.finished:
+            state = self.error and "failed" or self.cancelled.is_set() and "cancelled" or "done"
+        else:
+            state = "loading"
+        line = "{0}: {1}/{2} files, {3} rows read, {4} new, {5:.0f} rows/sec, {6:.1f} s".format(
+            state, self.files_done, len(self.files), self.rows, self.inserted, rate, elapsed)
+        eta = self.eta()
+        if eta is not None:
+            line += ", about {0:.0f} s left".format(eta)
+        if self.current:
+            line += "\n  now loading " + self.current
+        return line
 
+    def add_message(self, message):
+        with self.lock:
+            self.messages.append(message)
 
+    def take_messages(self):
+        with self.lock:
+            messages, self.messages = self.messages, []
+        return messages
 
 
 if __name__ == "__main__":
@@ -1,4 +1,22 @@
 from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import config
+
+
+def to_cents(value):
+    """Whole cents in an amount like '-12.34'. Raises ValueError if value isn't a number."""
+    value = value.strip()
+    digits = value.lstrip('+-')
+    whole, _, fraction = digits.partition('.')
+    if len(value) - len(digits) <= 1 and len(fraction) <= 2 and (whole + fraction).isdigit():
+        # the common case, decimal is slow enough to show up in big imports.
+        cents = int(whole or '0') * 100 + int(fraction.ljust(2, '0'))
+        return value[0] == '-' and -cents or cents
+    try:
+        return int((Decimal(value) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except InvalidOperation:
+        raise ValueError("not an amount: %r" % value)
+
 
 
 class Parser:
@@ -8,17 +26,25 @@ class Parser:
         self.description_field = description_field
         self.amount_field = amount_field
         self.amount_negated = amount_negated
+        # statements have a handful of distinct dates repeated over and over, only strptime each one once.
+        self.dates = {}
+
+    def parse_date(self, value):
+        dt = self.dates.get(value)
+        if dt is None:
+            dt = self.dates[value] = datetime.strptime(value, self.date_format)
+        return dt
 
     def parse(self, row):
         try:
-            amount = float(row[self.amount_field])
+            amount_cents = to_cents(row[self.amount_field])
             if self.amount_negated:
-                amount = -amount
+                amount_cents = -amount_cents
 
             return {
-                "date": datetime.strptime(row[self.date_field], self.date_format),
+                "date": self.parse_date(row[self.date_field]),
                 "description": row[self.description_field],
-                "amount": amount
+                "amount_cents": amount_cents
             }
 
         except ValueError:
@@ -29,3 +55,20 @@ class Parser:
 parsers = { 'amex': Parser(0, "%m/%d/%Y %a", 2, 7, True),
             'bofa': Parser(0, "%m/%d/%Y", 1, 2, False),
             'chase': Parser(1, "%m/%d/%Y", 3, 4, False)}
+
+
+def get_parser(name):
+    """
+    The parser called name. Besides the built in ones, parsers can be declared in the "parsers" section of the
+    config file, e.g.
+
+        "parsers": {"citi": {"date_field": 1, "date_format": "%m/%d/%Y", "description_field": 2,
+                             "amount_field": 3, "amount_negated": true}}
+    """
+    if name not in parsers:
+        profile = config.get('parsers', {}).get(name)
+        if profile is None:
+            raise KeyError("no parser called '%s', add one to the parsers section of %s" % (name, config.path()))
+        parsers[name] = Parser(profile['date_field'], profile['date_format'], profile['description_field'],
+                               profile['amount_field'], profile.get('amount_negated', False))
+    return parsers[name]
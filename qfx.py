@@ -0,0 +1,150 @@
+"""
+Incremental OFX/QFX reader.
+
+Walks the statement as a stream of tag/text events instead of building a document tree, so memory stays flat no
+matter how many transactions the file holds. Both the SGML flavour of OFX (leaf elements such as <NAME> are never
+closed) and the XML flavour are understood.
+"""
+from datetime import datetime
+from parser import to_cents
+
+CHUNK_SIZE = 64 * 1024
+
+START = 'start'
+END = 'end'
+TEXT = 'text'
+
+ENTITIES = (('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'), ('&apos;', "'"), ('&nbsp;', ' '), ('&amp;', '&'))
+
+
+def iter_events(fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Yield (kind, value) events from an OFX stream. kind is one of START, END or TEXT. Tag names are upper cased;
+    processing instructions, comments and declarations are skipped.
+    """
+    buf = ''
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        buf += chunk
+        pos = 0
+        while True:
+            lt = buf.find('<', pos)
+            if lt == -1:
+                # the text may continue in the next chunk, keep it around until we see the next tag.
+                break
+            if buf.startswith('<!--', lt):
+                gt = buf.find('-->', lt)
+                if gt == -1:
+                    break
+                if lt > pos:
+                    yield TEXT, buf[pos:lt]
+                pos = gt + 3
+                continue
+            gt = buf.find('>', lt)
+            if gt == -1:
+                break
+            if lt > pos:
+                yield TEXT, buf[pos:lt]
+            pos = gt + 1
+
+            tag = buf[lt + 1:gt].strip()
+            if not tag or tag[0] in '?!':
+                continue
+            if tag[0] == '/':
+                yield END, tag[1:].strip().upper()
+            elif tag[-1] == '/':
+                name = tag[:-1].split()[0].upper()
+                yield START, name
+                yield END, name
+            else:
+                yield START, tag.split()[0].upper()
+        buf = buf[pos:]
+
+
+def unescape(text):
+    if '&' not in text:
+        return text
+    for entity, char in ENTITIES:
+        text = text.replace(entity, char)
+    return text
+
+
+def parse_date(value):
+    # some qfx files have dates in the form: 20131207000000.000[-7:MST], others only carry the day.
+    value = value.strip()[:14]
+    if len(value) == 8:
+        return datetime.strptime(value, "%Y%m%d")
+    return datetime.strptime(value, "%Y%m%d%H%M%S")
+
+
+class QfxReader(object):
+    """
+    Reads transactions out of an OFX/QFX file one at a time.
+
+        reader = QfxReader(open(path))
+        org, fid = reader.header()
+        for tx in reader:
+            ...
+
+    Each transaction is a dict with date, amount_cents, description and fitid keys, the same keyword arguments that
+    db.insert_transaction expects.
+    """
+
+    def __init__(self, fileobj):
+        self.org = None
+        self.fid = None
+        self._pending = []
+        self._records = self._parse(iter_events(fileobj))
+
+    def header(self):
+        """Return (org, fid) of the institution. Only reads as far into the file as needed to find them."""
+        while self.fid is None and not self._pending:
+            try:
+                self._pending.append(next(self._records))
+            except StopIteration:
+                break
+        return self.org, self.fid
+
+    def __iter__(self):
+        while self._pending:
+            yield self._pending.pop(0)
+        for raw in self._records:
+            yield raw
+
+    def _parse(self, events):
+        current_tag = None
+        fields = None
+
+        for kind, value in events:
+            if kind == START:
+                if value == 'STMTTRN':
+                    fields = {}
+                current_tag = value
+            elif kind == END:
+                if value == 'STMTTRN' and fields is not None:
+                    yield self.transaction(fields)
+                    fields = None
+                current_tag = None
+            else:
+                text = value.strip()
+                if not text or current_tag is None:
+                    continue
+                text = unescape(text)
+                if fields is not None:
+                    fields[current_tag] = text
+                elif current_tag == 'ORG' and self.org is None:
+                    self.org = text
+                elif current_tag == 'FID' and self.fid is None:
+                    self.fid = text
+                current_tag = None
+
+    @staticmethod
+    def transaction(fields):
+        return {
+            'date': parse_date(fields['DTPOSTED']),
+            'amount_cents': to_cents(fields['TRNAMT']),
+            'description': fields.get('NAME') or fields.get('MEMO', ''),
+            'fitid': fields['FITID']
+        }
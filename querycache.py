@@ -0,0 +1,71 @@
+"""
+Results of the read queries, kept in memory so that flipping between list, bycat and cat over the same months
+doesn't run the same SQL again.
+
+Every entry is keyed on the query and its arguments plus the generation of the data it was read from. Anything that
+writes to the database bumps the generation, so entries read before a write are never handed out again, they just
+fall off the end of the LRU.
+"""
+import threading
+from collections import OrderedDict
+from itertools import chain
+
+SIZE = 64
+# bigger results are streamed as before instead of being kept.
+MAX_ROWS = 20000
+
+
+class QueryCache(object):
+
+    def __init__(self, size=SIZE, max_rows=MAX_ROWS):
+        self.size = size
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def changed(self):
+        with self.lock:
+            self.generation += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def get(self, key, read):
+        """
+        The rows for key, from the cache or by calling read(). read may return a list or a result proxy, which is
+        fetched into a list unless it has more than max_rows rows. Cached lists are shared, don't change them.
+        """
+        with self.lock:
+            key = (self.generation,) + key
+            rows = self.entries.get(key)
+            if rows is not None:
+                del self.entries[key]
+                self.entries[key] = rows
+                self.hits += 1
+                return rows
+            self.misses += 1
+
+        rows = read()
+        if not isinstance(rows, list):
+            fetched = rows.fetchmany(self.max_rows + 1)
+            if len(fetched) > self.max_rows:
+                return chain(fetched, rows)
+            rows = fetched
+
+        if self.size:
+            with self.lock:
+                self.entries[key] = rows
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return rows
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return "query cache: %d hits, %d misses (%.0f%% hits), %d of %d entries, generation %d" % (
+            self.hits, self.misses, lookups and 100.0 * self.hits / lookups or 0, len(self.entries), self.size,
+            self.generation)
@@ -1,11 +1,26 @@
+import time
+started = time.time()
+
 import cmd
+import csv
+import errno
+import itertools
+import json
+import os
+import subprocess
+import sys
 import db
-from datetime import date
+from datetime import date, timedelta
 
 import loader
 import logging
+import instrument
+import columnar
+import config
+import watcher
 import argparse
 from argparse import ArgumentError
+from collections import OrderedDict
 
 class Thyme(cmd.Cmd):
     """Simple command line interpreter to explore expenses"""
@@ -18,23 +33,136 @@ class Thyme(cmd.Cmd):
               "may": 6, "june": 6, "jun": 6, "jul": 7, "july": 7, "aug": 8, "august": 8, "sep": 9, "sept": 9,
               "oct": 10, "october": 10, "nov": 11, "november": 11, "dec": 12, "december": 12}
 
+    # default --limit for list --page, and how many rows list writes out at a time.
+    PAGE_SIZE = 50
+
     LIST_PARSER = argparse.ArgumentParser(description='List Parser')
     LIST_PARSER.add_argument("-f", "--filter", help='Search for transactions by this filter', default="")
     LIST_PARSER.add_argument('timerange', nargs='?', help='time range for transactions')
-    LIST_PARSER.add_argument('--new', const='new', dest='new', nargs='?', help='time range for transactions')
+    LIST_PARSER.add_argument('--new', const='new', dest='new', nargs='?', help='only transactions from the last load')
+    LIST_PARSER.add_argument('--load', type=int, help='only transactions from this load, see the loads command')
+    LIST_PARSER.add_argument('--limit', type=int, help='show at most this many transactions')
+    LIST_PARSER.add_argument('--offset', type=int, default=0, help='skip this many transactions')
+    LIST_PARSER.add_argument('--page', type=int, help='show this page of --limit (default %d) transactions' % PAGE_SIZE)
+    LIST_PARSER.add_argument('--pager', action='store_true', help='show the transactions through $PAGER')
+
+    LOAD_PARSER = argparse.ArgumentParser(description='Load Parser')
+    LOAD_PARSER.add_argument('-j', '--jobs', type=int, default=1, help='number of processes used to parse statements')
+    LOAD_PARSER.add_argument('-b', '--background', action='store_true', help='load while the prompt stays usable')
+    LOAD_PARSER.add_argument('action', nargs='?', choices=['status', 'cancel'], help='check on a background load')
+
+    TOP_PARSER = argparse.ArgumentParser(description='Top Parser')
+    TOP_PARSER.add_argument('-n', type=int, default=10, help='how many to show')
+    TOP_PARSER.add_argument('-d', '--descriptions', action='store_true', help='sum up by description')
+    TOP_PARSER.add_argument('timerange', nargs='?', help='time range for transactions')
+
+    TREND_PARSER = argparse.ArgumentParser(description='Trend Parser')
+    TREND_PARSER.add_argument('-c', '--category', help='only show this category')
+    TREND_PARSER.add_argument('-w', '--week', action='store_true', help='weekly instead of monthly totals')
+    TREND_PARSER.add_argument('-n', '--periods', type=int, default=12,
+                              help='without a time range, show this many months (or weeks) up to the current one')
+    TREND_PARSER.add_argument('-a', '--avg', type=int, default=0, help='show rolling averages over this many periods')
+    TREND_PARSER.add_argument('timerange', nargs='?', help='time range for transactions')
 
     def __init__(self):
         cmd.Cmd.__init__(self)
         self.tx_id_map = {}
+        # (query, {page: (date, id) of the last transaction on it}) for the last list --page.
+        self.list_pages = (None, {})
+        # tables go to out (stdout when it's None) as the aligned table or as json, csv or tsv records.
+        self.output_format = 'table'
+        self.out = None
+        self.command = None
+        self.profiler = instrument.Profiler()
+        self.load_job = None
+        self.watch = None
+        self.cache = None
+        if config.get('transaction_cache') and columnar.available():
+            self.cache = columnar.TransactionCache()
+
+    def precmd(self, line):
+        self.command = line
+        self.profiler.start(line)
+        return line
+
+    def postcmd(self, stop, line):
+        stats = self.profiler.finish()
+        if stats:
+            print(stats.report(self.profiler.SLOWEST))
+        self.report_load()
+        self.report_watch()
+        return stop
+
+    def report_load(self):
+        """Print what the background load did since the last command, and its status once it is over."""
+        job = self.load_job
+        if job is None:
+            return
+        for message in job.take_messages():
+            print(message)
+        if not job.is_alive():
+            print(job.status())
+            self.load_job = None
+
+    def report_watch(self):
+        if self.watch is not None:
+            for message in self.watch.take_messages():
+                print(message)
+
+    def display(self, *columns, **kwargs):
+        if kwargs.get('out') is None:
+            kwargs['out'] = self.out
+        if self.output_format == 'table':
+            return TabularDisplay(*columns, **kwargs)
+        return RecordDisplay(self.output_format, self.command, *columns, **kwargs)
+
+    def row_id(self, idx, tx):
+        """
+        What goes in the Id column, and what updcat takes afterwards: the row number at the prompt, the transaction's
+        own id in records.
+        """
+        return tx['id'] if self.output_format != 'table' else idx
+
+    def show_description(self, description, width):
+        if self.output_format != 'table':
+            return description
+        return " ".join(description.split()).title()[0:width - 1]
+
+    def run_commands(self, lines):
+        """
+        Run each line as if it was typed at the prompt, without the prompt or line editing. Blank lines and lines
+        starting with # are skipped. A background load is waited for at the end instead of being cancelled.
+        """
+        stop = False
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            line = self.precmd(line)
+            stop = self.postcmd(self.onecmd(line), line)
+            if stop:
+                break
+        if self.load_job is not None:
+            self.load_job.join()
+            self.report_load()
+        if not stop:
+            self.do_EOF('')
 
     def do_EOF(self, args):
+        if self.watch is not None:
+            self.watch.stop()
+        if self.load_job and self.load_job.is_alive():
+            print("cancelling the background load")
+            self.load_job.cancel()
+            self.load_job.join()
         return True
 
     def do_list(self, args=""):
         """
-        list transactions. The syntax is list [-f filter] [timerange]
+        list transactions. The syntax is list [-f filter] [--limit n] [--offset n | --page n] [--pager] [timerange]
 
-        The filter is matched against the transaction description as well as the category name.
+        The filter is matched against the words in the transaction description (prefixes work too, coff finds
+        coffee) as well as the category name.
         There are a few different ways to specify the timerange.
 
         Examples:
@@ -44,77 +172,367 @@ class Thyme(cmd.Cmd):
             list -f coffee jan  # show me tx's with the word coffee or the category coffee for january
             list -f pizza       # All transactions with the word pizza in them for the current month
             list --new -f uncat # Show all uncategorized transactions from the last load command.
+            list --load 3       # Show the transactions brought in by load 3, see loads.
+            list --page 2 2013  # The second 50 transactions of 2013, --limit sets the page size.
+            list --pager 2013   # All of 2013 through $PAGER (less -R by default).
         """
 
         parsed_args = self.LIST_PARSER.parse_args(args.split())
         logging.info(parsed_args)
 
         start, end = self.guess_time_range(parsed_args.timerange)
-        if parsed_args.new and not parsed_args.timerange:
-            start = date(2000, 1, 1)
-            end = date.today()
-
-        idx = 0
-        sum = 0.0
-
-        transactions = db.read_txn_for_time(start, end, parsed_args.filter, only_new=parsed_args.new)
-
-        td = TabularDisplay(('Id', -3), ('Acct', -8), ('Date', -10), ('Description', -30), ('Category', -20), ('Amount', 10, '*'))
-        td.print_header()
-
-        for tx in transactions:
-            desc = " ".join(tx['description'].split()).title()[0:29]
-            self.tx_id_map[idx] = tx["id"]
-            td.print_row(idx, tx['nickname'], tx['date'].isoformat(), desc, tx['name'].title(), self.print_amount(tx['amount']))
-
-            idx += 1
-            sum += tx['amount']
+        load_id = parsed_args.load
+        if parsed_args.new:
+            load_id = db.latest_load_id()
+            if not load_id:
+                print("Nothing has been loaded yet.")
+                return
+        if load_id and not parsed_args.timerange:
+            start, end = date.min, date.max
+
+        limit, offset, after = parsed_args.limit, parsed_args.offset, None
+        if parsed_args.page:
+            limit = limit or self.PAGE_SIZE
+            offset = (parsed_args.page - 1) * limit
+            query = (start, end, parsed_args.filter, load_id, limit)
+            if self.list_pages[0] != query:
+                self.list_pages = (query, {})
+            # having shown the page before this one, carry on from its last transaction instead of skipping offset.
+            after = self.list_pages[1].get(parsed_args.page - 1)
+
+        if self.cache is not None and not parsed_args.filter and not load_id:
+            transactions = self.cache.transactions(start, end, after, limit, after is None and offset or None)
+        else:
+            transactions = db.read_txn_for_time(start, end, parsed_args.filter, load_id, after, limit,
+                                                after is None and offset or None)
 
-        td.print_summary(self.print_amount(sum))
+        pager = None
+        out = None
+        if parsed_args.pager:
+            pager = subprocess.Popen(os.environ.get('PAGER') or 'less -R', shell=True, stdin=subprocess.PIPE)
+            out = pager.stdin
 
+        td = self.display(('Id', -3), ('Acct', -8), ('Date', -10), ('Description', -30), ('Category', -20),
+                          ('Amount', 10, '*'), out=out, buffer_rows=self.PAGE_SIZE)
+        self.tx_id_map = {}
+        idx = offset
+        sum = 0
+        last = None
+        try:
+            td.print_header()
+            for tx in transactions:
+                self.tx_id_map[self.row_id(idx, tx)] = tx["id"]
+                td.print_row(self.row_id(idx, tx), tx['nickname'], tx['date'].isoformat(),
+                             self.show_description(tx['description'], 30), tx['name'].title(),
+                             self.print_amount(tx['amount_cents']))
+
+                idx += 1
+                sum += tx['amount_cents']
+                last = (tx['date'], tx['id'])
+
+            td.print_summary(self.print_amount(sum))
+        except IOError as e:
+            # the pager was quit before everything was written.
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            if pager is not None:
+                try:
+                    out.close()
+                except IOError:
+                    pass
+                pager.wait()
+
+        if parsed_args.page and last is not None:
+            self.list_pages[1][parsed_args.page] = last
 
     def do_bycat(self, args=""):
-        """ show transactions by category. bycat 10 will aggregate transactions by category for the month of october"""
+        """
+        show transactions by category. bycat 10 will aggregate transactions by category for the month of october.
+        bycat --tree [timerange] shows sub-categories under their parents, with totals and budgets that include them.
+        """
+        args_array = args.split()
+        if "--tree" in args_array:
+            args_array.remove("--tree")
+            return self.print_category_tree(*self.guess_time_range(" ".join(args_array)))
+
         start, end = self.guess_time_range(args)
-        transactions = db.read_txn_for_time_by_category(start, end)
-        sum = 0.0
+        if self.cache is not None:
+            transactions = self.cache.by_category(start, end)
+        else:
+            transactions = db.read_txn_for_time_by_category(start, end)
+        sum = 0
 
         budget_map = {}
         total_budget = 0
         for cat in db.list_categories():
             budget_map[cat['name']] = cat['budget']
             total_budget += cat['budget']
-        td = TabularDisplay(('Category', -30), ('Total', 10, '*'), ('Budget', 10, '*'), ('Diff', 10, '*'))
+        td = self.display(('Category', -30), ('Total', 10, '*'), ('Budget', 10, '*'), ('Diff', 10, '*'))
         td.print_header()
 
-        for tx in transactions:
-            category_name = tx['name'].title()
+        for name, total in transactions:
+            category_name = name.title()
             if category_name == 'Transfer' or category_name == 'Paycheck':
                 continue
-            sum += float(tx[1])
-            diff = budget_map[tx['name']] + float(tx[1])
-            td.print_row(tx['name'].title(), self.print_amount(tx[1], color_negative=False), budget_map[tx['name']],
+            # budgets are whole dollars, totals are cents.
+            total = int(total)
+            sum += total
+            diff = budget_map[name] * 100 + total
+            td.print_row(category_name, self.print_amount(total, color_negative=False), budget_map[name],
                          self.print_amount(diff, color_negative=True))
-        td.print_summary(self.print_amount(sum), total_budget, self.print_amount(total_budget + sum, color_negative=True))
+        td.print_summary(self.print_amount(sum), total_budget,
+                         self.print_amount(total_budget * 100 + sum, color_negative=True))
+
+
+    def do_top(self, args=""):
+        """
+        the biggest expenses. The syntax is top [-n N] [--descriptions] [timerange]
+
+        Examples:
+
+            top                 # the 10 biggest expenses this month
+            top -n 5 jan:mar    # the 5 biggest expenses from january to march
+            top -d dec          # where most of the money went in december, summed up by description
+        """
+        parsed_args = self.TOP_PARSER.parse_args(args.split())
+        start, end = self.guess_time_range(parsed_args.timerange)
+
+        if parsed_args.descriptions:
+            if self.cache is not None:
+                rows = self.cache.top_descriptions(start, end, parsed_args.n)
+            else:
+                rows = db.read_top_descriptions(start, end, parsed_args.n)
+            td = self.display(('Description', -40), ('Count', 6), ('Amount', 10))
+            td.print_header()
+            for description, count, total in rows:
+                td.print_row(self.show_description(description, 40), count, self.print_amount(total))
+            return
+
+        if self.cache is not None:
+            transactions = self.cache.top_transactions(start, end, parsed_args.n)
+        else:
+            transactions = db.read_top_transactions(start, end, parsed_args.n)
+        td = self.display(('Id', -3), ('Acct', -8), ('Date', -10), ('Description', -30), ('Category', -20), ('Amount', 10))
+        self.tx_id_map = {}
+        td.print_header()
+        for idx, tx in enumerate(transactions):
+            self.tx_id_map[self.row_id(idx, tx)] = tx['id']
+            td.print_row(self.row_id(idx, tx), tx['nickname'], tx['date'].isoformat(),
+                         self.show_description(tx['description'], 30), tx['name'].title(),
+                         self.print_amount(tx['amount_cents']))
+
+    def do_cache(self, args=""):
+        """
+        cache on|off. With the cache on, list (without a filter), bycat and top work on a copy of the transactions
+        kept in memory, column by column. It needs numpy. Set "transaction_cache": true in the config file to start
+        with it on.
+        """
+        if args.strip() == "on" and self.cache is None:
+            if not columnar.available():
+                print("the cache needs numpy, pip install numpy")
+                return
+            started = time.time()
+            self.cache = columnar.TransactionCache()
+            self.cache.refresh()
+            print("cached %d transactions in %.2f s" % (len(self.cache), time.time() - started))
+        elif args.strip() == "off":
+            self.cache = None
+        print("cache is " + (self.cache is not None and "on" or "off"))
+
+    def print_category_tree(self, start, end):
+        children = {}
+        for cat in db.read_category_tree(start, end):
+            children.setdefault(cat['parent_id'], []).append(cat)
+
+        td = self.display(('Category', -30), ('Total', 10, '*'), ('Budget', 10, '*'), ('Diff', 10, '*'))
+        td.print_header()
+        totals = [0, 0]
+
+        def print_subtree(parent_id, depth):
+            for cat in sorted(children.get(parent_id, []), key=lambda c: c['name']):
+                if cat['name'].title() in ('Transfer', 'Paycheck') or (not cat['count'] and not cat['budget']):
+                    continue
+                total, budget = int(cat['total']), int(cat['budget'])
+                if depth == 0:
+                    totals[0] += total
+                    totals[1] += budget
+                td.print_row(("  " * depth + cat['name'].title())[0:30], self.print_amount(total), budget,
+                             self.print_amount(budget * 100 + total, color_negative=True))
+                print_subtree(cat['id'], depth + 1)
+
+        print_subtree(None, 0)
+        td.print_summary(self.print_amount(totals[0]), totals[1],
+                         self.print_amount(totals[1] * 100 + totals[0], color_negative=True))
+
+    def do_trend(self, args=""):
+        """
+        spending per category, month by month (or week by week), next to the average, the budget and how far the
+        average is from it. The syntax is trend [-c category] [--week] [-n periods] [--avg N] [timerange]
+
+        Examples:
+
+            trend               # the last 12 months
+            trend jan:jun       # january to june
+            trend -n 24 -a 3    # the last 24 months, each month showing the average of it and the two before
+            trend -w -c coffee  # coffee over the last 12 weeks
+        """
+        parsed_args = self.TREND_PARSER.parse_args(args.split())
+        weekly = parsed_args.week
+        if parsed_args.periods < 1:
+            print("trend needs at least one period, -n has to be 1 or more")
+            return
+
+        category_id = None
+        if parsed_args.category:
+            category_id = db.find_category_id(parsed_args.category.strip().lower())
+            if not category_id:
+                print("I couldn't find a category %s" % parsed_args.category)
+                return
+
+        periods = self.trend_periods(parsed_args.timerange, parsed_args.periods, weekly)
+        if not periods:
+            print("There is nothing to show in that time range")
+            return
+        if weekly:
+            end = periods[-1] + timedelta(days=7)
+        else:
+            end = self.next_month(periods[-1])
+
+        totals = {}
+        for name, period, total in db.read_trend(periods[0], end, category_id, weekly):
+            totals.setdefault(name, {})[period] = total
+
+        budget_map = {}
+        for cat in db.list_categories():
+            budget_map[cat['name']] = cat['budget']
+        # budgets are whole dollars a month.
+        budget_scale = weekly and 100 * 12 / 52.0 or 100
+
+        label = weekly and '%m/%d' or '%b %y'
+        columns = [('Category', -20)] + [(p.strftime(label), 8, '*') for p in periods] + \
+                  [('Avg', 8, '*'), ('Budget', 8, '*'), ('Diff', 10, '*')]
+        td = self.display(*columns)
+        td.print_header()
+
+        column_totals = [0] * (len(periods) + 3)
+        for name in sorted(totals):
+            if name.title() == 'Transfer' or name.title() == 'Paycheck':
+                continue
+            spent = [-totals[name].get(p, 0) for p in periods]
+            cells = parsed_args.avg > 0 and self.rolling_average(spent, parsed_args.avg) or spent
+            average = float(sum(spent)) / len(spent)
+            budget = budget_map.get(name, 0) * budget_scale
+            values = cells + [average, budget, budget - average]
+            column_totals = [t + v for t, v in zip(column_totals, values)]
+            td.print_row(name.title()[0:20], *self.trend_cells(values))
+        td.print_summary(*self.trend_cells(column_totals))
+
+    def trend_periods(self, timerange, count, weekly):
+        """The first day of every period trend shows: months, or weeks starting on monday."""
+        if timerange:
+            start, end = self.guess_time_range(timerange)
+        else:
+            today = date.today()
+            end = self.next_month(date(today.year, today.month, 1))
+            if weekly:
+                start = today - timedelta(days=7 * (count - 1))
+            else:
+                months = today.year * 12 + today.month - 1 - (count - 1)
+                start = date(months // 12, months % 12 + 1, 1)
+
+        periods = []
+        period = weekly and start - timedelta(days=start.weekday()) or start
+        while period < end and (timerange or not weekly or period <= date.today()):
+            periods.append(period)
+            period = weekly and period + timedelta(days=7) or self.next_month(period)
+        return periods
+
+    @staticmethod
+    def rolling_average(values, n):
+        """The average of every value and the n - 1 before it, or as many as there are at the start."""
+        averages = []
+        for i in range(len(values)):
+            window = values[max(0, i - n + 1):i + 1]
+            averages.append(float(sum(window)) / len(window))
+        return averages
+
+    def trend_cells(self, values):
+        # whole dollars keep a year of months on one line. The last value is the budget difference.
+        if self.output_format != 'table':
+            cells = [v / 100.0 for v in values[:-1]]
+        else:
+            cells = ['%d' % round(v / 100.0) for v in values[:-1]]
+        return cells + [self.print_amount(int(round(values[-1])), color_negative=True)]
 
+    def do_rebuild(self, args=""):
+        """ recompute the monthly totals used by bycat from the transactions table."""
+        db.rebuild_monthly_totals()
+        print("Monthly totals rebuilt")
 
     def do_updcat(self, args=""):
         """
-        update the category of one transaction. You can say `updcat <txid> <categoryname>'
+        update the category of transactions listed by the last list or top. You can say
+        `updcat <txids> <categoryname>', where txids is one id or a comma separated list of ids and ranges. The ids
+        are the ones in the Id column, the transaction ids when the output is json, csv or tsv.
+
+        Examples:
+
+            updcat 3 coffee
+            updcat 3,5,9-14 coffee   # 3, 5 and 9 to 14 inclusive, all in one go
         """
-        txid, category = args.split()
+        txids, category = args.split()
         trimmed_category = category.strip().lower()
         category_id = db.find_category_id(trimmed_category)
         if not category_id:
             print("I couldn't find a category %s" % trimmed_category)
+            return
+
+        try:
+            indexes = self.parse_ids(txids)
+        except ValueError:
+            print("I don't understand the transaction ids %s" % txids)
+            return
+        missing = [idx for idx in indexes if idx not in self.tx_id_map]
+        if missing:
+            print("no transaction %s in the last list" % ",".join(str(idx) for idx in missing))
+            return
+
+        ids = [self.tx_id_map[idx] for idx in indexes]
+        rowcount = db.update_tx_categories(ids, category_id)
+        if rowcount == 0:
+            print("no rows found")
         else:
-            rowcount = db.update_tx_category(self.tx_id_map[int(txid)], category_id)
-            if rowcount == 0:
-                print("no rows found")
-            else:
-                print("row updated")
+            if self.cache is not None:
+                self.cache.set_category(ids, category_id)
+            print(rowcount == 1 and "row updated" or "%d rows updated" % rowcount)
 
+    @staticmethod
+    def parse_ids(arg):
+        """3,5,9-14 -> [3, 5, 9, 10, 11, 12, 13, 14]"""
+        ids = []
+        for part in arg.split(","):
+            if "-" in part:
+                first, last = part.split("-")
+                ids.extend(range(int(first), int(last) + 1))
+            else:
+                ids.append(int(part))
+        return sorted(set(ids))
 
+    def do_recat(self, args=""):
+        """
+        categorize the transactions already loaded again, using the categories remembered by updcat and the
+        patterns added with cat match, the way they would be if they were loaded now.
+        recat --uncategorized only looks at the transactions that are uncategorized.
+        """
+        only_uncategorized = args.strip() in ("--uncategorized", "-u")
+        if args.strip() and not only_uncategorized:
+            print("The syntax is recat [--uncategorized]")
+            return
+        seen, moved = db.recategorize(only_uncategorized)
+        if moved and self.cache is not None:
+            self.cache = columnar.TransactionCache()
+        print("%d of %d transactions changed category" % (moved, seen))
 
     def do_cat(self, args):
         """
@@ -124,26 +542,51 @@ class Thyme(cmd.Cmd):
             cat                           # list out all categories
             cat list                      #  -- ditto --
             cat add booze                 # what can i say? i drink a lot!
+            cat add wine booze            # wine, a sub-category of booze
+            cat parent coffee food        # coffee becomes a sub-category of food, see bycat --tree
+            cat parent coffee none        # coffee is a top level category again
             cat update shopping 200       # set the budget for shopping to 200.
+            cat match coffee blue bottle  # transactions with the words 'blue bottle' go to coffee from now on.
+            cat match -p 5 tv prime video # patterns with a higher priority (0 by default) win over lower ones,
+                                          # and any of them over the built in ones.
         """
         args_array = args.split()
         command = args_array and args_array[0] or "list"
 
         if command == "list":
             budget = 0
-            td = TabularDisplay(('Name', -24), ('Budget', 6, '*'))
+            td = self.display(('Name', -24), ('Parent', -24), ('Budget', 6, '*'))
             td.print_header()
-            for cat in db.list_categories():
-                td.print_row(cat['name'].title(), cat['budget'])
+            cats = list(db.list_categories())
+            names = dict((cat['id'], cat['name']) for cat in cats)
+            for cat in cats:
+                td.print_row(cat['name'].title(), names.get(cat['parent_id'], '').title(), cat['budget'])
                 #print("%-4s %-24s %-4d" % (str(cat['id']), cat['name'], cat['budget']))
                 budget += cat['budget']
             td.print_summary(budget)
 
         elif command == "add":
-            if len(args_array) != 2:
-                print("I expect the name of the category you want to add")
+            if len(args_array) not in (2, 3):
+                print("I expect the name of the category you want to add, and optionally its parent")
+            elif len(args_array) == 3 and not db.find_category_id(args_array[2].lower()):
+                print("I could not find category '" + args_array[2] + "'")
+            else:
+                parent_id = len(args_array) == 3 and db.find_category_id(args_array[2].lower()) or None
+                db.insert_category(args_array[1], parent_id)
+        elif command == "parent":
+            if len(args_array) != 3:
+                print("I expect a category name and the name of its parent, or none")
             else:
-                db.insert_category(args_array[1])
+                category_id = db.find_category_id(args_array[1].lower())
+                parent_id = None
+                if args_array[2].lower() != "none":
+                    parent_id = db.find_category_id(args_array[2].lower())
+                if not category_id or (parent_id is None and args_array[2].lower() != "none"):
+                    print("I could not find category '" + (category_id and args_array[2] or args_array[1]) + "'")
+                elif not db.set_category_parent(category_id, parent_id):
+                    print("%s can't be its own parent" % args_array[1])
+                else:
+                    print("Category updated")
         elif command == "update":
             if len(args_array) != 3:
                 print("I expect a category name and amount")
@@ -152,6 +595,24 @@ class Thyme(cmd.Cmd):
                     print("Category updated")
                 else:
                     print("I could not find category '" + args_array[1] + "'")
+        elif command == "match":
+            priority = 0
+            if len(args_array) > 2 and args_array[1] in ("-p", "--priority"):
+                try:
+                    priority = int(args_array[2])
+                except ValueError:
+                    print("The priority has to be a number")
+                    return
+                args_array = args_array[:1] + args_array[3:]
+            if len(args_array) < 3:
+                print("I expect a category name and a pattern")
+            else:
+                category_id = db.find_category_id(args_array[1].lower())
+                if not category_id:
+                    print("I could not find category '" + args_array[1] + "'")
+                else:
+                    db.add_category_pattern(category_id, " ".join(args_array[2:]), priority)
+                    print("Pattern added")
         else:
             print("I don't understand " + command)
 
@@ -164,18 +625,132 @@ class Thyme(cmd.Cmd):
         args_array = args.split()
         command = args_array and args_array[0] or "list"
         if command == "list":
-            print("%-4s %-6s %-20s %6s" % ("Id", "Nickname", "Name", "Fid"))
-            print("-------------------------------------")
+            td = self.display(('Id', -4), ('Nickname', -6), ('Name', -20), ('Fid', 6))
+            td.print_header()
             for account in db.list_institutions():
-                print("%-4d %-6s %-20s %6d" % (account[0], account[1], account[2], account[3]))
+                fid = account[3]
+                if fid is None and self.output_format == 'table':
+                    # accounts created by csv imports only have a nickname, no fid.
+                    fid = ''
+                td.print_row(account[0], account[1], account[2], fid)
         elif command == "update":
             db.update_institution(int(args_array[1]), args_array[2])
 
 
     def do_load(self, args):
-        db.clear_last_load()
-        loader.load_qfx_new()
-        print("Use 'list --new' to see new transactions loaded by this command.")
+        """
+        load new statements from ~/Downloads. The syntax is load [--jobs N] [--background] [status|cancel]
+
+        A background load keeps the prompt usable: list, bycat and friends see every statement as soon as it is
+        completely stored. Its messages are printed after the next command.
+
+        Examples:
+
+            load                # load statements one after the other
+            load --jobs 4       # parse up to 4 statements at a time
+            load -b             # load in the background
+            load status         # files done, rows/sec and time left of the background load
+            load cancel         # stop the background load, the statement being loaded is rolled back
+        """
+        parsed_args = self.LOAD_PARSER.parse_args(args.split())
+        job = self.load_job
+        if parsed_args.action:
+            if job is None:
+                print("no load is running")
+            elif parsed_args.action == 'cancel':
+                job.cancel()
+                job.join()
+            else:
+                print(job.status())
+            return
+
+        if job is not None:
+            print("a load is already running, see 'load status'")
+            return
+
+        files = loader.new_statements()
+        if not files:
+            print("no new statements to load")
+        elif not parsed_args.background:
+            loader.load_files(files, parsed_args.jobs)
+            print("Use 'list --new' to see new transactions loaded by this command.")
+        else:
+            self.load_job = loader.LoadJob(files, parsed_args.jobs)
+            self.load_job.start()
+            print("loading {0} statements in the background, see 'load status'".format(len(files)))
+
+    def do_watch(self, args):
+        """
+        load statements as soon as they show up in ~/Downloads, while the prompt stays usable.
+        The syntax is watch [status|stop]. csv exports are loaded too when the "watch_csv" section of the config
+        file says which parser and account they are for.
+        """
+        action = args.strip()
+        if action == "stop":
+            if self.watch is not None:
+                self.watch.stop()
+                self.watch.join()
+                self.report_watch()
+                self.watch = None
+            print("not watching")
+        elif action in ("", "status"):
+            if self.watch is None and not action:
+                self.watch = watcher.Watch()
+                self.watch.start()
+            print(self.watch is not None and self.watch.status() or "not watching")
+        else:
+            print("The syntax is watch [status|stop]")
+
+    def do_loads(self, args):
+        """
+        list the loads so far, with the number of transactions and statements each brought in. loads <id> lists the
+        statements of one load, list --load <id> its transactions.
+        """
+        if args.strip():
+            td = self.display(('File', -60))
+            td.print_header()
+            for name in db.list_load_files(int(args)):
+                td.print_row(name)
+            return
+
+        td = self.display(('Id', -4), ('Started', -19), ('Transactions', 12), ('Files', 6), ('Source', -40))
+        td.print_header()
+        for load in db.list_loads():
+            started = load['started'] and load['started'].strftime('%Y-%m-%d %H:%M:%S') or ''
+            td.print_row(load['id'], started, load['transactions'] or 0, load['files'] or 0, load['source'] or '')
+
+    def do_timing(self, args):
+        """
+        timing on|off. With timing on, every command is followed by its wall time, the number of SQL statements it
+        ran, the time spent in the database, the rows fetched and its slowest statements.
+        """
+        if args.strip() == "on":
+            self.profiler.enable()
+        elif args.strip() == "off":
+            self.profiler.disable()
+        print("timing is " + (self.profiler.enabled and "on" or "off"))
+
+    def do_stats(self, args):
+        """ totals per command for everything run with timing on, how long startup took and how the query cache did."""
+        td = self.display(('Command', -12), ('Runs', 6, '*'), ('Wall ms', 10, '*'), ('Statements', 10, '*'),
+                          ('DB ms', 10, '*'), ('Rows', 8, '*'))
+        td.print_header()
+        runs = wall_time = statements = db_time = rows = 0
+        for name, total in self.profiler.summary():
+            td.print_row(name, total[0], round(total[1] * 1000, 1), total[2], round(total[3] * 1000, 1), total[4])
+            runs += total[0]
+            wall_time += total[1]
+            statements += total[2]
+            db_time += total[3]
+            rows += total[4]
+        td.print_summary(runs, round(wall_time * 1000, 1), statements, round(db_time * 1000, 1), rows)
+        print("")
+        print(db.startup_report())
+        print(db.query_cache.stats())
+
+    def do_sqllog(self, args):
+        """ sqllog on|off. Echo every SQL statement to thyme.log."""
+        db.log_sql(args.strip() == "on")
 
     @staticmethod
     def get_start_end(args):
@@ -257,74 +832,155 @@ class Thyme(cmd.Cmd):
         else:
             return date(year, month + 1, 1)
 
-    def print_amount(self, amount, color_negative=False):
-        if amount < 0.0:
+    @staticmethod
+    def format_cents(cents):
+        dollars, remainder = divmod(abs(cents), 100)
+        return '%10s' % ('%s%d.%02d' % (cents < 0 and '-' or '', dollars, remainder))
+
+    def print_amount(self, cents, color_negative=False):
+        if self.output_format != 'table':
+            # records get the signed amount as a number instead of the colors.
+            return cents / 100.0
+        if cents < 0:
             if color_negative:
-                return self.RED + '%10.2f' % -amount + self.END
+                return self.RED + self.format_cents(-cents) + self.END
             else:
-                return '%10.2f' % -amount
+                return self.format_cents(-cents)
         else:
-            return self.GREEN + ('%10.2f' % amount) + self.END
+            return self.GREEN + self.format_cents(cents) + self.END
 
 
 
 class TabularDisplay(object):
+    """
+    Prints rows of fixed width columns. A column is (title, width) or (title, width, '*') for the ones that get a
+    value in the summary line. The row format is put together once, and with buffer_rows set rows are written to out
+    that many at a time instead of one write per row.
+    """
 
-    def __init__(self, *columns):
+    def __init__(self, *columns, **kwargs):
         self.columns = columns
-        self.header = ""
-        self.divider = ""
+        self.out = kwargs.get('out') or sys.stdout
+        self.buffer_rows = kwargs.get('buffer_rows', 1)
+        self.buffer = []
+
+        formats = ["%" + str(column[1]) + "s" for column in self.columns]
+        self.row_format = " ".join(formats)
+        self.header = self.row_format % tuple(column[0] for column in self.columns)
+        self.divider = "-" * len(self.header)
+        # the summary only has values under the '*' columns, the others are left blank.
+        self.summary_columns = [len(column) > 2 for column in self.columns]
+
+    def write(self, line):
+        self.buffer.append(line)
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.out.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+        self.out.flush()
 
-        # print("%-3s %-8s %-8s %-30s %-16s %-12s" %
+    def print_header(self):
+        self.write(self.header)
+        self.write(self.divider)
 
-        for column in self.columns:
-            if self.header:
-                self.header += " "
-            fmt = "%" + str(column[1]) + 's'
-            self.header += (fmt % column[0])
+    def print_row(self, *values):
+        if len(values) != len(self.columns):
+            raise ArgumentError
+        self.write(self.row_format % values)
+
+    def print_summary(self, *values):
+        values = iter(values)
+        self.write(self.divider)
+        self.write(self.row_format % tuple(next(values) if wanted else ' ' for wanted in self.summary_columns))
+        self.flush()
+
+class RecordDisplay(TabularDisplay):
+    """
+    TabularDisplay for scripts: every row is written as a json object (one per line, with the command that printed
+    it under "query"), or a csv or tsv record under a header of the column names. Values are written without the
+    padding, and summaries are left out.
+    """
+
+    def __init__(self, format, command, *columns, **kwargs):
+        TabularDisplay.__init__(self, *columns, **kwargs)
+        self.format = format
+        self.command = command
+        self.keys = [column[0].lower().replace(' ', '_') for column in columns]
+        if format != 'json':
+            self.writer = csv.writer(self.out, delimiter=format == 'tsv' and '\t' or ',', lineterminator='\n')
+
+    @staticmethod
+    def value(value):
+        if isinstance(value, basestring):
+            value = value.strip()
+        return value
 
-        # I'm sure there is a better way to do this! No stackoverlow over the pacific :(
-        for i in xrange(len(self.header)):
-            self.divider += "-"
+    @staticmethod
+    def encode(value):
+        return value.encode('utf-8') if isinstance(value, unicode) else value
 
     def print_header(self):
-        print(self.header)
-        print(self.divider)
+        if self.format != 'json':
+            self.writer.writerow(self.keys)
 
     def print_row(self, *values):
         if len(values) != len(self.columns):
             raise ArgumentError
-        # man, this is ugly. no other words
-
-        row = ""
-        idx = 0
-        for column in self.columns:
-            if row:
-                row += " "
-            format = "%" + str(column[1]) + 's'
-            row += (format % values[idx])
-            idx += 1
-
-        print(row)
+        values = [self.value(v) for v in values]
+        if self.format == 'json':
+            record = OrderedDict([('query', self.command)] + zip(self.keys, values))
+            self.write(json.dumps(record))
+        else:
+            self.writer.writerow([self.encode(v) for v in values])
 
     def print_summary(self, *values):
-        print(self.divider)
-        summary = ""
-        values_idx = 0
-        for column in self.columns:
-            if summary:
-                summary += ' '
-
-            fmt = "%" + str(column[1]) + 's'
-            if len(column) > 2:
-                summary += (fmt % values[values_idx])
-                values_idx += 1
-            else:
-                summary += (fmt % ' ')
+        self.flush()
 
-        print(summary)
 
 if __name__ == '__main__':
+    db.startup_timings.insert(0, ('imports', time.time() - started))
+
+    arg_parser = argparse.ArgumentParser(description='Thyme & money: command line personal finance')
+    arg_parser.add_argument('--timing', action='store_true', help='report where startup time went')
+    arg_parser.add_argument('--watch', action='store_true', help='load statements as they land in ~/Downloads')
+    arg_parser.add_argument('-c', '--command', action='append', dest='commands',
+                            help='run this command instead of starting the prompt, can be given more than once')
+    arg_parser.add_argument('-s', '--script', help="run the commands in this file, - reads them from stdin")
+    arg_parser.add_argument('--format', choices=['table', 'json', 'csv', 'tsv'], default='table',
+                            help='write tables as json lines, csv or tsv records instead')
+    startup_args = arg_parser.parse_args()
+
+    if startup_args.watch:
+        watch = watcher.Watch()
+        print("watching %s, ctrl-c to stop" % watch.dir)
+        try:
+            watch.run()
+        except KeyboardInterrupt:
+            pass
+        exit(0)
+
     thyme = Thyme()
+    thyme.output_format = startup_args.format
+    if startup_args.timing:
+        db.get_engine()
+        print(db.startup_report())
+
+    if startup_args.commands or startup_args.script:
+        if startup_args.format != 'table':
+            # keep stdout to the records, everything else print()s goes to stderr.
+            thyme.out = sys.stdout
+            sys.stdout = sys.stderr
+        lines = startup_args.commands or []
+        if startup_args.script == '-':
+            lines = itertools.chain(lines, sys.stdin)
+        elif startup_args.script:
+            with open(startup_args.script) as f:
+                lines += f.readlines()
+        thyme.run_commands(lines)
+        exit(0)
+
     thyme.prompt = "thyme> "
     thyme.cmdloop()
\ No newline at end of file
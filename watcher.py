@@ -0,0 +1,248 @@
+"""
+Loads statements as they land in ~/Downloads.
+
+On Linux the directory is watched with inotify (through ctypes, no extra packages), so nothing is read until a file
+is written or moved in. Anywhere else, or when inotify can't be set up, the directory is polled: a listdir and a stat
+of the statement-looking files every few seconds. Either way a file is only loaded once it has been left alone for a
+couple of seconds, browsers write downloads in several goes.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+from os.path import expanduser
+
+import db
+import loader
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event: wd, mask, cookie, len, followed by len bytes of NUL padded name.
+EVENT = struct.Struct('iIII')
+
+# seconds a file has to stay untouched before it is loaded.
+SETTLE = 2.0
+POLL_INTERVAL = 5.0
+
+# browsers download to one of these and rename to the real name when they are done.
+PARTIAL_SUFFIXES = ('.part', '.crdownload', '.download', '.partial', '.tmp')
+
+
+def is_watched(name):
+    if name.startswith('.') or name.lower().endswith(PARTIAL_SUFFIXES):
+        return False
+    return db.is_statement(name) or loader.csv_target(name) is not None
+
+
+def new_files(dir):
+    """Statements and known csv exports in dir that haven't been loaded, in name order."""
+    files = []
+    for name in sorted(os.listdir(dir)):
+        path = os.path.join(dir, name)
+        if is_watched(name) and os.path.isfile(path) and db.need_to_load(path, os.stat(path)):
+            files.append(path)
+    return files
+
+
+class InotifyWatcher(object):
+    """Names of the files closed after writing or moved into a directory, straight from the kernel."""
+
+    def __init__(self, dir):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, dir, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "can't watch " + dir)
+        # the kernel dropped events, whoever reads them has to look at the whole directory again.
+        self.overflowed = False
+
+    def changes(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        names = []
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip('\0')
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+            elif name:
+                names.append(name)
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """The same as InotifyWatcher, by comparing the size and mtime of the statement-looking files every interval."""
+
+    def __init__(self, dir, interval=None):
+        self.dir = dir
+        self.interval = interval or POLL_INTERVAL
+        self.overflowed = False
+        self.seen = self.scan()
+        self.next_scan = time.time() + self.interval
+
+    def scan(self):
+        seen = {}
+        for name in os.listdir(self.dir):
+            if is_watched(name):
+                try:
+                    stat = os.stat(os.path.join(self.dir, name))
+                except OSError:
+                    continue
+                seen[name] = (stat.st_size, int(stat.st_mtime))
+        return seen
+
+    def changes(self, timeout):
+        wait = self.next_scan - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        if wait > 0:
+            time.sleep(wait)
+        self.next_scan = time.time() + self.interval
+
+        seen = self.scan()
+        names = [name for name, state in seen.items() if self.seen.get(name) != state]
+        self.seen = seen
+        return names
+
+    def close(self):
+        pass
+
+
+def open_watcher(dir):
+    try:
+        return InotifyWatcher(dir)
+    except (OSError, AttributeError):
+        # no inotify (not linux, or out of watches): fall back to polling.
+        return PollingWatcher(dir)
+
+
+class Watch(threading.Thread):
+    """
+    Loads what is already waiting in dir, then keeps loading new statements and csv exports as they arrive until
+    stop() is called. Files that arrive together are loaded as one load. Run it as a thread (messages are kept in
+    watch.messages, like LoadJob's) or call run() directly to watch in the foreground.
+    """
+
+    def __init__(self, dir=None, jobs=1, settle=SETTLE):
+        threading.Thread.__init__(self, name='thyme-watch')
+        self.daemon = True
+        self.dir = dir or expanduser("~") + "/Downloads"
+        self.jobs = jobs
+        self.settle = settle
+        self.pending = {}
+        self.stopped = threading.Event()
+        self.mode = None
+        self.files_loaded = 0
+        self.messages = []
+        self.lock = threading.Lock()
+        self.report = loader.say
+
+    def start(self):
+        self.report = self.add_message
+        threading.Thread.start(self)
+
+    def run(self):
+        watcher = open_watcher(self.dir)
+        self.mode = isinstance(watcher, InotifyWatcher) and "inotify" or "polling"
+        try:
+            self.load(new_files(self.dir))
+            while not self.stopped.is_set():
+                now = time.time()
+                for name in watcher.changes(self.settle / 2):
+                    if is_watched(name):
+                        self.mark(os.path.join(self.dir, name), now)
+                if watcher.overflowed:
+                    watcher.overflowed = False
+                    for path in new_files(self.dir):
+                        self.mark(path, now)
+                self.load(self.ready())
+        finally:
+            watcher.close()
+
+    @staticmethod
+    def state(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def mark(self, path, now):
+        self.pending[path] = (now, self.state(path))
+
+    def ready(self):
+        """
+        The pending files that haven't changed for settle seconds and still need loading. Polling only notices a
+        change every few seconds, so the size and mtime are compared as well.
+        """
+        now = time.time()
+        files = []
+        for path, (changed, state) in sorted(self.pending.items()):
+            if now - changed < self.settle:
+                continue
+            if self.state(path) != state:
+                self.mark(path, now)
+                continue
+            del self.pending[path]
+            if state is not None and db.need_to_load(path, os.stat(path)):
+                files.append(path)
+        return files
+
+    def load(self, files):
+        if not files:
+            return
+        statements = [f for f in files if db.is_statement(os.path.basename(f))]
+        exports = [f for f in files if f not in statements]
+        try:
+            load_id = None
+            if statements:
+                job = loader.LoadJob(statements, self.jobs)
+                job.report = self.report
+                load_id = loader.load_files(statements, self.jobs, job)
+            for f in exports:
+                load_id = loader.load_csv(f, load_id, self.report)
+            self.files_loaded += len(files)
+        except Exception as e:
+            # one bad download shouldn't stop the watch, it is tried again when it changes.
+            self.report("couldn't load {0}: {1}".format(", ".join(files), e))
+
+    def stop(self):
+        self.stopped.set()
+
+    def status(self):
+        return "watching {0} ({1}), {2} files loaded, {3} waiting to settle".format(
+            self.dir, self.mode or "starting", self.files_loaded, len(self.pending))
+
+    def add_message(self, message):
+        with self.lock:
+            self.messages.append(message)
+
+    def take_messages(self):
+        with self.lock:
+            messages, self.messages = self.messages, []
+        return messages